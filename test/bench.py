@@ -0,0 +1,290 @@
+"""
+UNFS benchmarks. Mounts UNFS over node dirs in a tmpfs and prints the
+results as JSON, so runs against different versions can be compared.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import optparse
+import unfs
+
+WORKLOADS = ['metadata', 'readdir', 'sequential', 'random', 'smallfiles']
+
+class Bench(object):
+    """
+    Runs each workload on a fresh mount over empty nodes.
+    """
+
+    def __init__(self, base, nodes, mountOptions):
+        """
+        Init benchmark under base with nodes node dirs, mounting with the
+        given '-o' string.
+        """
+
+        self.base = base
+        self.mountOptions = mountOptions
+        unfs.base = base
+        unfs.mountPoint = base + '/unfs'
+        unfs.nodeMountPoint = base + '/fs'
+        self.nodes = [unfs.nodeMountPoint + '/n%d' % i for i in range(nodes)]
+
+    def setUp(self):
+        """
+        Make empty nodes and a mountpoint, and mount UNFS.
+        """
+
+        unfs.stop()
+        shutil.rmtree(self.base, True)
+        os.makedirs(unfs.mountPoint)
+        for node in self.nodes:
+            os.makedirs(node)
+
+    def mount(self):
+        """
+        Start UNFS.
+        """
+
+        unfs.go(self.mountOptions)
+
+    def tearDown(self):
+        """
+        Stop UNFS and remove everything.
+        """
+
+        unfs.stop()
+        time.sleep(1)
+        shutil.rmtree(self.base, True)
+
+    def rate(self, count, func, *args):
+        """
+        Call func(*args) count times, returns calls per second.
+        """
+
+        start = time.time()
+        for i in xrange(count):
+            func(i, *args)
+        return count / (time.time() - start)
+
+    def metadata(self, opts):
+        """
+        create, stat and unlink of empty files, in ops per second.
+        """
+
+        os.mkdir(unfs.mountPoint + '/meta')
+        name = lambda i: unfs.mountPoint + '/meta/f%d' % i
+
+        return {
+            'create': self.rate(opts.files,
+                lambda i: os.close(os.open(name(i), os.O_CREAT | os.O_WRONLY,
+                    0644))),
+            'stat': self.rate(opts.files, lambda i: os.stat(name(i))),
+            'statMissing': self.rate(opts.files,
+                lambda i: os.path.exists(name(i) + '.missing')),
+            'unlink': self.rate(opts.files, lambda i: os.unlink(name(i))),
+        }
+
+    def readdir(self, opts):
+        """
+        Listing a dir of opts.entries names spread over the nodes, in seconds
+        for the first listing after mounting and for a second one.
+        """
+
+        # made straight on the nodes, the mount would take ages
+        for node in self.nodes:
+            os.mkdir(node + '/big')
+        for i in xrange(opts.entries):
+            node = self.nodes[i % len(self.nodes)]
+            open(node + '/big/f%d' % i, 'w').close()
+
+        self.mount()
+        results = {}
+        for run in ('cold', 'warm'):
+            start = time.time()
+            count = len(os.listdir(unfs.mountPoint + '/big'))
+            results[run] = time.time() - start
+        assert count == opts.entries, count
+        results['entries'] = count
+        return results
+
+    def sequential(self, opts):
+        """
+        Writing then reading a opts.size MB file in 1MB blocks, in MB/s.
+        """
+
+        path = unfs.mountPoint + '/seq'
+        buf = os.urandom(1024 * 1024)
+
+        start = time.time()
+        f = open(path, 'w')
+        for _ in xrange(opts.size):
+            f.write(buf)
+        f.close()
+        write = opts.size / (time.time() - start)
+
+        start = time.time()
+        f = open(path, 'r')
+        while f.read(1024 * 1024):
+            pass
+        f.close()
+        read = opts.size / (time.time() - start)
+
+        os.unlink(path)
+        return {'writeMBs': write, 'readMBs': read}
+
+    def random(self, opts):
+        """
+        4k writes then reads at random offsets of a opts.size MB file, in
+        ops per second.
+        """
+
+        path = unfs.mountPoint + '/rand'
+        blocks = opts.size * 256
+        f = open(path, 'w')
+        f.truncate(opts.size * 1024 * 1024)
+        f.close()
+
+        buf = os.urandom(4096)
+        offsets = [random.randrange(blocks) * 4096 for _ in xrange(opts.ops)]
+        fd = os.open(path, os.O_RDWR)
+
+        def writeAt(i):
+            """
+            One 4k write.
+            """
+
+            os.lseek(fd, offsets[i], os.SEEK_SET)
+            os.write(fd, buf)
+
+        def readAt(i):
+            """
+            One 4k read.
+            """
+
+            os.lseek(fd, offsets[i], os.SEEK_SET)
+            os.read(fd, 4096)
+
+        results = {
+            'writeIOPS': self.rate(opts.ops, writeAt),
+            'readIOPS': self.rate(opts.ops, readAt),
+        }
+        os.close(fd)
+        os.unlink(path)
+        return results
+
+    def smallfiles(self, opts):
+        """
+        Like testManyFiles and testManyFilesRsync: writing, reading, copying
+        and deleting opts.files 10k files, in files per second.
+        """
+
+        src = unfs.mountPoint + '/files'
+        dst = unfs.mountPoint + '/newfiles'
+        os.mkdir(src)
+        data = os.urandom(10 * 1024)
+        names = ['%s/%s%d' % (src, ''.join(random.sample('1234567890ABCDEF',
+            16)), i) for i in xrange(opts.files)]
+
+        def write(i):
+            """
+            Write one file.
+            """
+
+            f = open(names[i], 'w')
+            f.write(data)
+            f.close()
+
+        results = {
+            'write': self.rate(opts.files, write),
+            'read': self.rate(opts.files, lambda i: open(names[i]).read()),
+        }
+
+        start = time.time()
+        if os.system('rsync -a %s %s 2>/dev/null' % (src, dst)):
+            shutil.copytree(src, dst)
+        results['copy'] = opts.files / (time.time() - start)
+
+        results['unlink'] = self.rate(opts.files, lambda i: os.unlink(names[i]))
+        shutil.rmtree(dst)
+        os.rmdir(src)
+        return results
+
+    def run(self, workload, opts):
+        """
+        Run one workload on a fresh mount. Returns its results.
+        """
+
+        self.setUp()
+        try:
+            # readdir fills the nodes before mounting
+            if workload != 'readdir':
+                self.mount()
+            return getattr(self, workload)(opts)
+        finally:
+            self.tearDown()
+
+def version():
+    """
+    Commit of the tree being benchmarked, or None outside git.
+    """
+
+    here = os.path.dirname(os.path.abspath(unfs.__file__))
+    commit = os.popen('git -C %s rev-parse --short HEAD 2>/dev/null' % \
+        here).read().strip()
+    return commit or None
+
+def main():
+    """
+    Parse arguments, run workloads, print JSON.
+    """
+
+    parser = optparse.OptionParser(usage='%prog [options] [workload ...]',
+        description='workloads: ' + ', '.join(WORKLOADS))
+    parser.add_option('--base', default='/dev/shm/unfs-bench',
+        help='dir to build nodes and mountpoint in, best on tmpfs')
+    parser.add_option('--nodes', type='int', default=4,
+        help='number of node dirs')
+    parser.add_option('--delay', default='',
+        help='latency injected per node call, as the nodedelay mount option')
+    parser.add_option('-o', dest='options', default='',
+        help='other UNFS mount options')
+    parser.add_option('--files', type='int', default=5000,
+        help='files for metadata and smallfiles')
+    parser.add_option('--entries', type='int', default=100000,
+        help='entries in the readdir dir')
+    parser.add_option('--size', type='int', default=256,
+        help='MB in the sequential and random files')
+    parser.add_option('--ops', type='int', default=10000,
+        help='4k operations for random')
+    parser.add_option('--output', help='write JSON here, not stdout')
+    opts, workloads = parser.parse_args()
+
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            parser.error('unknown workload %s' % workload)
+
+    mountOptions = ','.join([o for o in [opts.options,
+        opts.delay and 'nodedelay=' + opts.delay] if o])
+    bench = Bench(opts.base, opts.nodes, mountOptions)
+    results = {
+        'version': version(),
+        'started': time.time(),
+        'nodes': opts.nodes,
+        'mountOptions': mountOptions,
+        'params': {'files': opts.files, 'entries': opts.entries,
+            'size': opts.size, 'ops': opts.ops},
+        'results': {},
+    }
+    for workload in workloads or WORKLOADS:
+        sys.stderr.write('%s...\n' % workload)
+        results['results'][workload] = bench.run(workload, opts)
+
+    out = opts.output and open(opts.output, 'w') or sys.stdout
+    json.dump(results, out, indent=1, sort_keys=True)
+    out.write('\n')
+
+if __name__ == '__main__':
+    main()
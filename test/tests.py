@@ -3,11 +3,14 @@ UNFS tests.
 """
 
 import os
+import errno
 import md5
+import json
 import stat
 import random
 import popen2
 import shutil
+import sqlite3
 import threading
 import time
 import unittest
@@ -200,6 +203,926 @@ class TestUnfs(unittest.TestCase):
 
         os.rmdir(testDir)
 
+    def nodesWith(self, path):
+        """
+        helper method, names of nodes holding virtual path
+        """
+
+        return [nodeName for nodeName, nodePath in self.nodes.iteritems() \
+            if os.path.lexists(nodePath + path)]
+
+    def testRename(self):
+        """
+        mv a file and a dir spread over nodes, make sure nothing changes node.
+        """
+
+        self.assertEqual(self.nodesWith('/media/tv/sdf.avi'), ['t1'])
+        os.rename(unfs.mountPoint + '/media/tv/sdf.avi',
+            unfs.mountPoint + '/media/music/sdf.avi')
+        self.assertEqual(self.nodesWith('/media/music/sdf.avi'), ['t1'])
+
+        os.rename(unfs.mountPoint + '/media', unfs.mountPoint + '/moved')
+        self.assertEqual(self.nodesWith('/moved/music/sdf.avi'), ['t1'])
+        self.assertEqual(self.nodesWith('/moved/music/mp3'), ['t3'])
+        self.assertFalse(os.path.exists(unfs.mountPoint + '/media'))
+
+        os.rename(unfs.mountPoint + '/moved', unfs.mountPoint + '/media')
+        os.rename(unfs.mountPoint + '/media/music/sdf.avi',
+            unfs.mountPoint + '/media/tv/sdf.avi')
+        self.assertEqual(self.nodesWith('/media/tv/sdf.avi'), ['t1'])
+
+        # made on t1 for the first mv
+        os.rmdir(self.nodes['t1'] + '/media/music')
+
+    def testRenameOntoNotEmpty(self):
+        """
+        mv a dir onto one that is empty on one node but not on another, and
+        onto a file; make sure they fail and no node changes.
+        """
+
+        unfs.findNewNodes()
+        fs = unfs.UNFS()
+        for nodeName in ('t1', 't2'):
+            os.mkdir(self.nodes[nodeName] + '/from')
+            os.mkdir(self.nodes[nodeName] + '/onto')
+        open(self.nodes['t2'] + '/onto/f', 'w').close()
+        open(self.nodes['t4'] + '/file', 'w').close()
+
+        self.assertEqual(fs.rename('/from', '/onto'), -errno.ENOTEMPTY)
+        self.assertEqual(fs.rename('/from', '/file'), -errno.ENOTDIR)
+        self.assertEqual(fs.rename('/file', '/onto'), -errno.EISDIR)
+        self.assertEqual(sorted(self.nodesWith('/from')), ['t1', 't2'])
+        self.assertEqual(sorted(self.nodesWith('/onto')), ['t1', 't2'])
+        self.assertEqual(self.nodesWith('/onto/f'), ['t2'])
+        self.assertEqual(self.nodesWith('/file'), ['t4'])
+
+        os.unlink(self.nodes['t2'] + '/onto/f')
+        self.assertEqual(fs.rename('/from', '/onto'), None)
+        self.assertEqual(self.nodesWith('/from'), [])
+        self.assertEqual(sorted(self.nodesWith('/onto')), ['t1', 't2'])
+
+        for nodeName in ('t1', 't2'):
+            os.rmdir(self.nodes[nodeName] + '/onto')
+        os.unlink(self.nodes['t4'] + '/file')
+
+    def testStripe(self):
+        """
+        Remount with a striped dir, write a file of a few chunks, make sure
+        every node got chunks and that it reads back.
+        """
+
+        self.unfs_stop()
+        unfs.go('stripedirs=/striped,stripesize=65536')
+
+        os.mkdir(unfs.mountPoint + '/striped')
+        fileName = unfs.mountPoint + '/striped/f'
+        data = open('/dev/urandom', 'r').read(1024 * 1024)
+        fp = open(fileName, 'w')
+        fp.write(data)
+        fp.close()
+
+        self.assertEqual(os.stat(fileName)[stat.ST_SIZE], len(data))
+        self.assertEqual(open(fileName, 'r').read(), data)
+        self.assertEqual(len(self.nodesWith('/striped/.unfs-stripe.f')),
+            len(self.nodes))
+
+        os.unlink(fileName)
+        self.assertEqual(self.nodesWith('/striped/.unfs-stripe.f'), [])
+        os.rmdir(unfs.mountPoint + '/striped')
+
+    def testReplicas(self):
+        """
+        Remount keeping 2 copies, make sure a new file and its mode land on 2
+        nodes.
+        """
+
+        self.unfs_stop()
+        unfs.go('replicas=2')
+
+        shutil.copyfile(self.testFile, self.testFileDest)
+        self.assertEqual(len(self.nodesWith('/blah.txt')), 2)
+        self.assertEqual(open(self.testFileDest, 'r').read(),
+            open(self.testFile, 'r').read())
+
+        os.chmod(self.testFileDest, 0600)
+        for nodeName in self.nodesWith('/blah.txt'):
+            mode = os.stat(self.nodes[nodeName] + '/blah.txt')[stat.ST_MODE]
+            self.assertEqual(stat.S_IMODE(mode), 0600)
+
+        os.unlink(self.testFileDest)
+        self.assertEqual(self.nodesWith('/blah.txt'), [])
+
+    def testStats(self):
+        """
+        Stats files count what went through the mount and can't be written.
+        """
+
+        shutil.copyfile(self.testFile, self.testFileDest)
+        self.assertEqual(sorted(os.listdir(unfs.mountPoint + '/.unfs')),
+            ['stats', 'stats.prom', 'trace'])
+
+        stats = json.load(open(unfs.mountPoint + '/.unfs/stats', 'r'))
+        self.assert_(stats['ops']['write']['count'] > 0)
+        self.assertEqual(sum([c['value'] for c in \
+            stats['counters']['bytes_written']]),
+            os.stat(self.testFile)[stat.ST_SIZE])
+
+        prom = open(unfs.mountPoint + '/.unfs/stats.prom', 'r').read()
+        self.assert_('unfs_op_seconds_count{op="write"}' in prom)
+        self.assertRaises(IOError, open, unfs.mountPoint + '/.unfs/stats', 'w')
+
+    def testTrace(self):
+        """
+        Remount tracing everything, make sure a copy shows up in the trace
+        with the node it went to.
+        """
+
+        self.unfs_stop()
+        unfs.go('tracerate=1')
+
+        shutil.copyfile(self.testFile, self.testFileDest)
+        node = self.nodes[self.nodesWith('/blah.txt')[0]]
+        trace = open(unfs.mountPoint + '/.unfs/trace', 'r').read()
+        self.assert_('write /blah.txt - ' in trace)
+        self.assert_('write /blah.txt %s ' % node in trace)
+
+    def runThreads(self, target, groups):
+        """
+        helper method, run target(group) in a thread per group, returns the
+        seconds until all are done
+        """
+
+        start = time.time()
+        threads = [threading.Thread(target=target, args=(group,)) \
+            for group in groups]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def testParallel(self):
+        """
+        Remount with slow nodes, make sure 4 readers or writers on their own
+        files get through faster than one doing the same work.
+        """
+
+        self.unfs_stop()
+        unfs.go('nodedelay=0.005')
+
+        blocks = 32
+        names = [unfs.mountPoint + '/par%d' % i for i in range(8)]
+        errors = []
+
+        def writeFiles(group):
+            """
+            Write each file a 64k block at a time.
+            """
+
+            try:
+                for name in group:
+                    fd = os.open(name, os.O_CREAT | os.O_WRONLY, 0644)
+                    for i in range(blocks):
+                        os.write(fd, name[-1] * 65536)
+                    os.close(fd)
+            except OSError, why:
+                errors.append(why)
+
+        def readFiles(group):
+            """
+            Read each file back and check it.
+            """
+
+            for name in group:
+                if open(name, 'r').read() != name[-1] * 65536 * blocks:
+                    errors.append(name)
+
+        serial = self.runThreads(writeFiles, [names[:4]])
+        parallel = self.runThreads(writeFiles, [[name] for name in names[4:]])
+        print 'write: 1 thread %.2fs, 4 threads %.2fs' % (serial, parallel)
+        self.assert_(parallel < serial * 0.75)
+
+        # a new daemon, so the kernel has to come back for the data
+        self.unfs_stop()
+        unfs.go('nodedelay=0.005')
+        serial = self.runThreads(readFiles, [names[:4]])
+        parallel = self.runThreads(readFiles, [[name] for name in names[4:]])
+        print 'read: 1 thread %.2fs, 4 threads %.2fs' % (serial, parallel)
+        self.assert_(parallel < serial * 0.75)
+
+        self.assertEqual(errors, [])
+        for name in names:
+            os.unlink(name)
+
+    def testLowLevel(self):
+        """
+        Remount through the low level backend, make sure files, dirs and
+        renames look the same as through the compatibility mode.
+        """
+
+        try:
+            import unfsll
+        except ImportError:
+            self.skipTest('llfuse is not installed')
+
+        self.unfs_stop()
+        unfsll.go()
+
+        shutil.copyfile(self.testFile, self.testFileDest)
+        self.assertEqual(sorted(os.listdir(unfs.mountPoint)),
+            ['blah.txt', 'media'])
+        self.assertEqual(sorted(os.listdir(unfs.mountPoint + '/media')),
+            ['music', 'tv'])
+
+        os.mkdir(unfs.mountPoint + '/dir')
+        os.rename(self.testFileDest, unfs.mountPoint + '/dir/moved.txt')
+        self.assertFalse(os.path.exists(self.testFileDest))
+        self.assertEqual(open(unfs.mountPoint + '/dir/moved.txt', 'r').read(),
+            open(self.testFile, 'r').read())
+
+        os.chmod(unfs.mountPoint + '/dir/moved.txt', 0600)
+        self.assertEqual(stat.S_IMODE(os.stat(unfs.mountPoint + \
+            '/dir/moved.txt')[stat.ST_MODE]), 0600)
+
+        os.unlink(unfs.mountPoint + '/dir/moved.txt')
+        os.rmdir(unfs.mountPoint + '/dir')
+        self.assertEqual(sorted(os.listdir(unfs.mountPoint)), ['media'])
+
+    def testLowLevelErrors(self):
+        """
+        Open a path no node holds and fail a call unexpectedly through the
+        low level backend; make sure both come back as errors, not
+        exceptions that would stop the llfuse loop.
+        """
+
+        try:
+            import unfsll, llfuse
+        except ImportError:
+            self.skipTest('llfuse is not installed')
+
+        unfs.findNewNodes()
+        ops = unfsll.UnfsOperations()
+        inode = ops.inodes.lookup('/gone')
+        for flags in (os.O_RDONLY, os.O_WRONLY):
+            try:
+                ops.open(inode, flags, None)
+                self.fail('opened a missing file')
+            except llfuse.FUSEError, why:
+                self.assertEqual(why.errno, errno.ENOENT)
+        self.assertEqual(self.nodesWith('/gone'), [])
+
+        try:
+            unfsll.call(lambda: None + 1)
+            self.fail('no error')
+        except llfuse.FUSEError, why:
+            self.assertEqual(why.errno, errno.EIO)
+
+    def testLowLevelWriteBack(self):
+        """
+        Write less than a buffer through the low level backend; make sure
+        getattr sees it before the file is closed.
+        """
+
+        try:
+            import unfsll
+        except ImportError:
+            self.skipTest('llfuse is not installed')
+
+        self.fakeSpace({'t1': 500, 't2': 500, 't3': 500, 't4': 500})
+        ops = unfsll.UnfsOperations()
+        fh, attrs = ops.create(1, 'buffered', 0644, os.O_WRONLY, None)
+        ops.write(fh, 0, 'x' * 5000)
+        self.assertTrue(unfs.writeBack.handles)
+        self.assertEqual(ops.getattr(attrs.st_ino, None).st_size, 5000)
+        ops.release(fh)
+        ops.unlink(1, 'buffered', None)
+
+    def testWriteBack(self):
+        """
+        Small writes are buffered, make sure fsync and stat see all of them.
+        """
+
+        fd = os.open(self.testFileDest, os.O_CREAT | os.O_WRONLY, 0644)
+        for i in range(100):
+            os.write(fd, '%099d\n' % i)
+        self.assertEqual(os.stat(self.testFileDest)[stat.ST_SIZE], 10000)
+        os.write(fd, 'tail')
+        os.fsync(fd)
+        node = self.nodes[self.nodesWith('/blah.txt')[0]]
+        self.assertEqual(os.stat(node + '/blah.txt')[stat.ST_SIZE], 10004)
+        os.close(fd)
+
+        data = open(self.testFileDest, 'r').read()
+        self.assertEqual(data[-104:], '%099d\ntail' % 99)
+        os.unlink(self.testFileDest)
+
+    def testPlacement(self):
+        """
+        Remount keeping new files with their siblings, except round robin in
+        one dir; make sure they land accordingly.
+        """
+
+        self.unfs_stop()
+        unfs.go('placement=parent,placementdirs=/rr:roundrobin')
+
+        for dirName in ('/kept', '/rr'):
+            os.mkdir(unfs.mountPoint + dirName)
+            for i in range(8):
+                open(unfs.mountPoint + '%s/f%d' % (dirName, i), 'w').close()
+
+        kept = set([self.nodesWith('/kept/f%d' % i)[0] for i in range(8)])
+        spread = set([self.nodesWith('/rr/f%d' % i)[0] for i in range(8)])
+        self.assertEqual(len(kept), 1)
+        self.assertEqual(len(spread), len(self.nodes))
+
+        for dirName in ('/kept', '/rr'):
+            for i in range(8):
+                os.unlink(unfs.mountPoint + '%s/f%d' % (dirName, i))
+            os.rmdir(unfs.mountPoint + dirName)
+
+    def testReservation(self):
+        """
+        Remount reserving more than a node holds per file being written; make
+        sure files open at once land on different nodes.
+        """
+
+        self.unfs_stop()
+        unfs.go('reservation=%d' % (1024 ** 5))
+
+        files = [open(unfs.mountPoint + '/reserved%d' % i, 'w') \
+            for i in range(len(self.nodes))]
+        for f in files:
+            f.write('data')
+        placed = set([self.nodesWith('/reserved%d' % i)[0] \
+            for i in range(len(self.nodes))])
+        for f in files:
+            f.close()
+        self.assertEqual(len(placed), len(self.nodes))
+
+        for i in range(len(self.nodes)):
+            os.unlink(unfs.mountPoint + '/reserved%d' % i)
+
+    def testCacheTier(self):
+        """
+        Remount with a cache tier, read a file through once, then a few more
+        times; make sure only the repeated reads get it copied to the tier,
+        and that writing it drops the copy.
+        """
+
+        tier = self.testDir + '/ssd'
+        os.mkdir(tier)
+        self.unfs_stop()
+        unfs.go('tiernode=%s,tierpromote=4' % tier)
+
+        fileName = unfs.mountPoint + '/hot'
+        data = open('/dev/urandom', 'r').read(4 * 1024 * 1024)
+        open(fileName, 'w').write(data)
+        self.assertEqual(open(fileName, 'r').read(), data)
+
+        copy = tier + '/' + unfs.reservedPrefix + 'cache/hot'
+        time.sleep(1)
+        self.assertFalse(os.path.exists(copy))
+
+        for _ in range(3):
+            self.assertEqual(open(fileName, 'r').read(), data)
+        for _ in range(50):
+            if os.path.exists(copy):
+                break
+            time.sleep(0.1)
+        self.assertEqual(open(copy, 'r').read(), data)
+
+        open(fileName, 'a').write('more')
+        self.assertFalse(os.path.exists(copy))
+        self.assertEqual(open(fileName, 'r').read(), data + 'more')
+
+        os.unlink(fileName)
+        shutil.rmtree(tier)
+
+    def testRepairStripe(self):
+        """
+        Write a striped file below a replicated dir, and repair with and
+        without the dir still striped; make sure its manifest isn't copied
+        as a replica and that it reads back.
+        """
+
+        self.fakeSpace({'t1': 500, 't2': 500, 't3': 500, 't4': 500})
+        saved = (unfs.stripeDirs, unfs.stripeSize, unfs.replicationDirs)
+        unfs.stripeDirs, unfs.stripeSize = '/s', 4096
+        unfs.replicationDirs = '/s:2'
+        fs = unfs.UNFS()
+        try:
+            fs.mkdir('/s', 0755)
+            handle = fs.UnfsFile('/s/g', os.O_CREAT | os.O_WRONLY, 0644)
+            handle.write('hello', 0)
+            handle.release(0)
+            holders = self.nodesWith('/s/g')
+
+            for stripeDirs in ('/s', ''):
+                unfs.stripeDirs = stripeDirs
+                unfs.repairer.repair()
+                self.assertEqual(self.nodesWith('/s/g'), holders)
+                handle = fs.UnfsFile('/s/g', os.O_RDONLY)
+                self.assertEqual(handle.read(5, 0), 'hello')
+                handle.release(0)
+            fs.unlink('/s/g')
+            fs.rmdir('/s')
+        finally:
+            unfs.stripeDirs, unfs.stripeSize, unfs.replicationDirs = saved
+
+    def testRenameOpen(self):
+        """
+        Rename a file open for writing, as logrotate does; make sure it still
+        counts as open under its new name, so the rebalancer leaves it, and
+        that later writes land.
+        """
+
+        unfs.findNewNodes()
+        unfs.spaceMonitor.sample()
+        fs = unfs.UNFS()
+        handle = fs.UnfsFile('/app.log', os.O_CREAT | os.O_WRONLY, 0644)
+        handle.write('line1\n', 0)
+        fs.rename('/app.log', '/app.log.1')
+
+        self.assertTrue(unfs.openFiles.isOpen('/app.log.1'))
+        self.assertFalse(unfs.openFiles.isOpen('/app.log'))
+        self.assertEqual(handle.virtualPath, '/app.log.1')
+        node = handle.node
+        other = [n for n in unfs.unfsNodes if n != node][0]
+        self.assertFalse(unfs.rebalancer.move('/app.log.1', node, other))
+
+        handle.write('line2\n', 6)
+        handle.release(0)
+        self.assertFalse(unfs.openFiles.isOpen('/app.log.1'))
+        self.assertEqual(open(node + '/app.log.1').read(), 'line1\nline2\n')
+        fs.unlink('/app.log.1')
+
+    def fakeSpace(self, free):
+        """
+        helper method, make the space monitor see 1000 byte nodes with
+        free[nodeName] bytes free
+        """
+
+        unfs.findNewNodes()
+        unfs.spaceMonitor.stats = dict([(self.nodes[nodeName],
+            (1, 1, 1000, free[nodeName], free[nodeName], 0, 0, 0, 0, 255)) \
+            for nodeName in free])
+        unfs.spaceMonitor.sampled = time.time()
+
+    def testRebalance(self):
+        """
+        Fill one node with small files; make sure the rebalancer plans to
+        even out free space within the threshold and quota, leaves open files
+        alone, moves nothing on a dry run, and moves the plan otherwise.
+        """
+
+        os.mkdir(self.nodes['t1'] + '/rebal')
+        for i in range(5):
+            open(self.nodes['t1'] + '/rebal/f%d' % i, 'w').write('x' * 150)
+        planned = lambda plan: sorted([path for path, _, _, _ in plan \
+            if path.startswith('/rebal/')])
+
+        # 50 against 52 percent free is within rebalancethreshold
+        self.fakeSpace({'t1': 500, 't2': 510, 't3': 520, 't4': 510})
+        self.assertEqual(unfs.rebalancer.plan(), [])
+
+        # 100 free against 900, 400 bytes even them out
+        self.fakeSpace({'t1': 100, 't2': 500, 't3': 900, 't4': 500})
+        plan = unfs.rebalancer.plan()
+        self.assertTrue(sum([size for _, _, _, size in plan]) <= 400)
+        self.assertEqual(len(planned(plan)), 2)
+        self.assertEqual(set([(src, dst) for _, src, dst, _ in plan]),
+            set([(self.nodes['t1'], self.nodes['t3'])]))
+
+        handle = unfs.UNFS().UnfsFile('/rebal/f0', os.O_RDONLY)
+        try:
+            self.assertFalse('/rebal/f0' in planned(unfs.rebalancer.plan()))
+        finally:
+            handle.release(0)
+
+        unfs.rebalanceDryRun = 1
+        try:
+            report = unfs.rebalancer.rebalance()
+        finally:
+            unfs.rebalanceDryRun = 0
+        self.assertTrue('(dry run)' in report)
+        self.assertTrue('/rebal/f' in report)
+        self.assertEqual(sorted(os.listdir(self.nodes['t1'] + '/rebal')),
+            ['f%d' % i for i in range(5)])
+        self.assertFalse(os.path.exists(self.nodes['t3'] + '/rebal'))
+
+        moved = planned(unfs.rebalancer.plan())
+        unfs.rebalancer.rebalance()
+        for path in moved:
+            self.assertEqual(self.nodesWith(path), ['t3'])
+        self.assertEqual(len(os.listdir(self.nodes['t1'] + '/rebal')), 3)
+
+        for nodePath in self.nodes.values():
+            shutil.rmtree(nodePath + '/rebal', True)
+
+    def testRebalanceChanged(self):
+        """
+        Append to a file while the rebalancer copies it; make sure it stays
+        where it was and the copy is cleaned up.
+        """
+
+        os.mkdir(self.nodes['t1'] + '/rebal')
+        fileName = self.nodes['t1'] + '/rebal/f'
+        open(fileName, 'w').write('x' * 150)
+        unfs.findNewNodes()
+
+        appended = []
+        def append(length):
+            """
+            Throttle that writes to the file being copied, once.
+            """
+
+            if not appended:
+                appended.append(length)
+                open(fileName, 'a').write('y')
+
+        self.assertFalse(unfs.rebalancer.move('/rebal/f', self.nodes['t1'],
+            self.nodes['t2'], append))
+        self.assertEqual(self.nodesWith('/rebal/f'), ['t1'])
+        self.assertEqual(os.listdir(self.nodes['t2'] + '/rebal'), [])
+        self.assertEqual(open(fileName).read(), 'x' * 150 + 'y')
+
+        for nodePath in self.nodes.values():
+            shutil.rmtree(nodePath + '/rebal', True)
+
+    def testThrottle(self):
+        """
+        Make sure Throttle keeps to its bandwidth and operation rate.
+        """
+
+        for bandwidth, iops, length in ((10000, 0, 1000), (0, 20, 1)):
+            throttle = unfs.Throttle(bandwidth, iops)
+            start = time.time()
+            for _ in range(10):
+                throttle(length)
+            elapsed = time.time() - start
+            self.assertTrue(0.45 <= elapsed < 1.5, elapsed)
+
+    def testShadowOrder(self):
+        """
+        Put a file on the first and last node, the last looking faster; make
+        sure lookups return the first, unless the path is replicated.
+        """
+
+        unfs.findNewNodes()
+        first, last = unfs.unfsNodes[0], unfs.unfsNodes[-1]
+        open(first + '/dup', 'w').write('first')
+        open(last + '/dup', 'w').write('last')
+
+        saved = dict(unfs.nodeStats.latency)
+        unfs.nodeStats.latency.update({first: 10.0, last: 0.0})
+        try:
+            unfs.locationCache.clear()
+            self.assertEqual(unfs.findNode('/dup')[0], first)
+
+            unfs.replicationFactor = 2
+            unfs.locationCache.clear()
+            self.assertEqual(unfs.findNode('/dup')[0], last)
+        finally:
+            unfs.replicationFactor = 1
+            unfs.nodeStats.latency.clear()
+            unfs.nodeStats.latency.update(saved)
+            unfs.locationCache.clear()
+
+        os.unlink(first + '/dup')
+        os.unlink(last + '/dup')
+
+    def nodeCalls(self):
+        """
+        helper method, node calls made so far
+        """
+
+        return sum([c['value'] for c in \
+            unfs.metrics.snapshot()['counters'].get('node_calls', [])])
+
+    def testLocationCache(self):
+        """
+        Make sure the location cache evicts the least recently used path and
+        drops whole trees.
+        """
+
+        cache = unfs.LocationCache(2)
+        cache.set('/a', 't1')
+        cache.set('/b', 't2')
+        self.assertEqual(cache.get('/a'), 't1')
+        cache.set('/c', 't3')
+        self.assertEqual(cache.get('/b'), None)
+        self.assertEqual((cache.get('/a'), cache.get('/c')), ('t1', 't3'))
+
+        cache = unfs.LocationCache(10)
+        for path in ('/d', '/d/e', '/d/e/f', '/de'):
+            cache.set(path, 't1')
+        cache.invalidate('/d', tree=True)
+        self.assertEqual([cache.get(path) for path in ('/d', '/d/e',
+            '/d/e/f', '/de')], [None, None, None, 't1'])
+
+    def testLocationCacheOps(self):
+        """
+        Look a file up twice; make sure the second time checks just the node
+        it is on, and that rename, unlink and rmdir drop what they change.
+        """
+
+        unfs.findNewNodes()
+        unfs.locationCache.clear()
+        fs = unfs.UNFS()
+        node = self.nodes['t3']
+        open(node + '/located', 'w').close()
+
+        self.assertEqual(unfs.findNode('/located')[0], node)
+        self.assertEqual(unfs.locationCache.get('/located'), node)
+        calls = self.nodeCalls()
+        self.assertEqual(unfs.findNode('/located')[0], node)
+        self.assertEqual(self.nodeCalls(), calls + 1)
+
+        fs.rename('/located', '/moved')
+        self.assertEqual(unfs.locationCache.get('/located'), None)
+        self.assertEqual(unfs.locationCache.get('/moved'), node)
+        fs.unlink('/moved')
+        self.assertEqual(unfs.locationCache.get('/moved'), None)
+
+        fs.mkdir('/dir', 0755)
+        unfs.findNode('/dir')
+        self.assertTrue(unfs.locationCache.get('/dir'))
+        unfs.locationCache.set('/dir/stale', node)
+        fs.rmdir('/dir')
+        self.assertEqual(unfs.locationCache.get('/dir'), None)
+        self.assertEqual(unfs.locationCache.get('/dir/stale'), None)
+
+    def testNegativeCache(self):
+        """
+        Look up a missing path twice; make sure the second time asks no node,
+        and that creating it any way makes it visible at once.
+        """
+
+        self.fakeSpace({'t1': 500, 't2': 500, 't3': 500, 't4': 500})
+        fs = unfs.UNFS()
+        self.assertEqual(fs.getattr('/missing'), -errno.ENOENT)
+        calls = self.nodeCalls()
+        self.assertEqual(fs.getattr('/missing'), -errno.ENOENT)
+        self.assertEqual(self.nodeCalls(), calls)
+
+        open(self.nodes['t1'] + '/src', 'w').close()
+        creates = [
+            ('/node', lambda path: fs.mknod(path, stat.S_IFREG | 0644, 0)),
+            ('/dir', lambda path: fs.mkdir(path, 0755)),
+            ('/link', lambda path: fs.symlink('src', path)),
+            ('/moved', lambda path: fs.rename('/src', path)),
+            ('/created', lambda path: fs.UnfsFile(path,
+                os.O_CREAT | os.O_WRONLY, 0644).release(0)),
+        ]
+        for path, create in creates:
+            self.assertEqual(fs.getattr(path), -errno.ENOENT)
+            self.assertTrue(unfs.negativeCache.hit(path))
+            create(path)
+            self.assertFalse(unfs.negativeCache.hit(path))
+            self.assertFalse(isinstance(fs.getattr(path), int), path)
+
+        for path in ('/node', '/link', '/moved', '/created'):
+            fs.unlink(path)
+        fs.rmdir('/dir')
+
+    def testNegativeCacheRace(self):
+        """
+        Create a path while a lookup is missing it on the nodes; make sure
+        the lookup doesn't leave it cached as missing.
+        """
+
+        unfs.findNewNodes()
+        fs = unfs.UNFS()
+        timed = unfs.nodeStats.timed
+
+        def racing(node, func, *args):
+            """
+            Miss on the first node, creating the path there just after.
+            """
+
+            if args == (node + '/raced',) and not os.path.exists(args[0]):
+                unfs.nodeStats.timed = timed
+                open(node + '/raced', 'w').close()
+                unfs.pathCreated('/raced', node)
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+            return timed(node, func, *args)
+
+        unfs.nodeStats.timed = racing
+        try:
+            self.assertEqual(unfs.findNode('/raced'), (None, None))
+        finally:
+            unfs.nodeStats.timed = timed
+        self.assertFalse(unfs.negativeCache.hit('/raced'))
+        self.assertFalse(isinstance(fs.getattr('/raced'), int))
+        fs.unlink('/raced')
+
+    def readdirHits(self):
+        """
+        helper method, readdir resumes that found their cursor so far
+        """
+
+        return unfs.metrics.snapshot()['caches'].get('readdir',
+            {}).get('hit', 0)
+
+    def testReaddirResume(self):
+        """
+        List a dir spread over the nodes a few entries at a time, the way the
+        kernel does when its buffer fills, with the cursor sometimes evicted
+        in between; make sure every name comes back exactly once.
+        """
+
+        unfs.findNewNodes()
+        fs = unfs.UNFS()
+        nodeNames = sorted(self.nodes)
+        for nodeName in nodeNames:
+            os.mkdir(self.nodes[nodeName] + '/spread')
+            open(self.nodes[nodeName] + '/spread/everywhere', 'w').close()
+        names = ['f%02d' % i for i in range(30)]
+        for i, name in enumerate(names):
+            open(self.nodes[nodeNames[i % 4]] + '/spread/' + name, 'w').close()
+
+        saved = unfs.readdirBatch
+        unfs.readdirBatch = 4
+        try:
+            for evict in (False, True):
+                listed = []
+                offset = 0
+                resumes = 0
+                hits = self.readdirHits()
+                while True:
+                    entries = fs.readdir('/spread', offset)
+                    taken = 0
+                    # the kernel takes 5, the 6th doesn't fit
+                    for entry in entries:
+                        if taken == 5:
+                            break
+                        listed.append(entry.name)
+                        offset = entry.offset
+                        taken += 1
+                    else:
+                        break
+                    resumes += 1
+                    if evict:
+                        for i in range(unfs.readdirCursorCount):
+                            unfs.readdirCursors.set(('/other', i), None)
+                self.assertEqual(sorted(listed),
+                    sorted(['.', '..', 'everywhere'] + names))
+                self.assertTrue(resumes > 4)
+                self.assertEqual(self.readdirHits() - hits,
+                    not evict and resumes or 0)
+        finally:
+            unfs.readdirBatch = saved
+
+        for nodeName in nodeNames:
+            shutil.rmtree(self.nodes[nodeName] + '/spread')
+
+    def testBreaker(self):
+        """
+        Make one node slower than nodetimeout; make sure fan outs give up on
+        it, that it is degraded after breaker timeouts and left out of
+        lookups and placement, and that restoring it clears the negative
+        cache.
+        """
+
+        self.fakeSpace({'t1': 100, 't2': 900, 't3': 100, 't4': 100})
+        slow = self.nodes['t2']
+        saved = (unfs.nodeTimeout, unfs.breakerThreshold, unfs.nodeDelays)
+        unfs.nodeTimeout, unfs.breakerThreshold = 0.2, 2
+        unfs.nodeDelays = 't2:0.5'
+        unfs.parseNodeDelays()
+        unfs.breaker.start()
+        open(slow + '/only', 'w').close()
+        try:
+            for _ in range(unfs.breakerThreshold):
+                self.assertFalse(unfs.breaker.isDegraded(slow))
+                results = dict([(node, why) for node, _, why in \
+                    unfs.fanOut(os.path.exists)])
+                self.assertEqual(results[slow].errno, errno.ETIMEDOUT)
+                time.sleep(0.5)
+            self.assertTrue(unfs.breaker.isDegraded(slow))
+
+            self.assertEqual(unfs.breaker.live(unfs.unfsNodes),
+                [node for node in unfs.unfsNodes if node != slow])
+            self.assertFalse(slow in [node for node, _, _ in unfs.fanOut(
+                os.path.exists)])
+            self.assertFalse(slow in unfs.placeNodes(len(unfs.unfsNodes)))
+            unfs.locationCache.clear()
+            self.assertEqual(unfs.findNode('/only')[0], None)
+
+            self.assertTrue(unfs.negativeCache.hit('/only'))
+            unfs.breaker.restore(slow)
+            self.assertFalse(unfs.negativeCache.hit('/only'))
+            self.assertFalse(unfs.breaker.isDegraded(slow))
+        finally:
+            unfs.nodeTimeout, unfs.breakerThreshold, unfs.nodeDelays = saved
+            unfs.parseNodeDelays()
+            unfs.breaker.restore(slow)
+            unfs.locationCache.clear()
+            os.unlink(slow + '/only')
+
+    def testIndexRename(self):
+        """
+        Rename non-ASCII paths in an index, closed and open; make sure the
+        open one finds the file under its new name.
+        """
+
+        node = self.nodes['t1']
+        unfs.NamespaceIndex().rename('/caf\xc3\xa9', '/d\xc3\xa9j\xc3\xa0')
+
+        indexPath = self.testDir + '/index.db'
+        index = unfs.NamespaceIndex()
+        index.open(indexPath)
+        index.add('/caf\xc3\xa9/f', node, stat.S_IFREG)
+        index.rename('/caf\xc3\xa9', '/d\xc3\xa9j\xc3\xa0')
+        for _ in range(50):
+            if index.lookup('/d\xc3\xa9j\xc3\xa0/f'):
+                break
+            time.sleep(0.1)
+        self.assertEqual(index.lookup('/d\xc3\xa9j\xc3\xa0/f'), node)
+        self.assertEqual(index.lookup('/caf\xc3\xa9/f'), None)
+        os.system('rm -f %s*' % indexPath)
+
+    def testIndexBatches(self):
+        """
+        Queue a few batches of writes to an index; make sure every one of
+        them lands.
+        """
+
+        unfs.findNewNodes()
+        node = self.nodes['t1']
+        indexPath = self.testDir + '/index.db'
+        index = unfs.NamespaceIndex()
+        for i in range(3000):
+            index.writes.put(('INSERT INTO paths VALUES (?, ?, ?, ?, ?)',
+                ('/f%d' % i, 't1', stat.S_IFREG, 0, 0)))
+        index.open(indexPath)
+        for _ in range(50):
+            if index.lookup('/f2999'):
+                break
+            time.sleep(0.1)
+        self.assertEqual(index.lookup('/f2999'), node)
+        db = sqlite3.connect(indexPath)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM paths')
+            .fetchone()[0], 3000)
+        db.close()
+        os.system('rm -f %s*' % indexPath)
+
+    def testFsck(self):
+        """
+        Put a file on two nodes and leave empty dirs on one behind UNFS'
+        back; make sure the checker finds both and indexes the first copy,
+        but takes dirs missing from a node added since for neither.
+        """
+
+        import unfsfsck
+
+        for nodeName in ('t2', 't4'):
+            shutil.copyfile(self.testFile, self.nodes[nodeName] + '/twice.txt')
+        # t4 joined after /kept was made
+        for nodeName in ('t1', 't2', 't3'):
+            os.makedirs(self.nodes[nodeName] + '/kept/empty')
+        os.mkdir(self.nodes['t3'] + '/kept/leftover')
+        os.mkdir(self.nodes['t3'] + '/leftover')
+
+        unfs.findNewNodes()
+        indexPath = self.testDir + '/index.db'
+        report = unfsfsck.check(unfs.unfsNodes, indexPath=indexPath)
+
+        self.assertEqual([entry['path'] for entry in report['shadowed']],
+            ['/twice.txt'])
+        self.assertEqual(report['orphans'],
+            [{'path': '/kept/leftover', 'nodes': [self.nodes['t3']]}])
+        self.assertEqual(report['partial'],
+            [{'path': '/leftover', 'nodes': [self.nodes['t3']]}])
+        self.assertEqual(unfsfsck.problems(report), 2)
+        self.assertEqual(report['usage'][self.nodes['t1']]['files'], 1)
+
+        twice = os.path.basename(report['shadowed'][0]['copies'][0]['node'])
+        index = unfs.NamespaceIndex()
+        index.path = indexPath
+        self.assertEqual(index.lookup('/twice.txt'),
+            unfs.nodeMountPoint + '/' + twice)
+        self.assertEqual(os.path.basename(index.lookup('/media/tv/sdf.avi')),
+            't1')
+
+        for nodeName in ('t2', 't4'):
+            os.unlink(self.nodes[nodeName] + '/twice.txt')
+        for nodeName in ('t1', 't2', 't3'):
+            shutil.rmtree(self.nodes[nodeName] + '/kept')
+        os.rmdir(self.nodes['t3'] + '/leftover')
+        os.system('rm -f %s*' % indexPath)
+
+    def testParseOptions(self):
+        """
+        Parse a -o string as the tools do; make sure known options come back
+        typed and the rest as written.
+        """
+
+        values, rest = unfs.parseOptions(
+            'replicas=2,tracerate=0.5,allow_other,,fsname=unfs')
+        self.assertEqual(vars(values), {'replicas': 2, 'tracerate': 0.5})
+        self.assertEqual(rest, ['allow_other', 'fsname=unfs'])
+
     def testABigFile(self):
         """
         big file, stress test kinda thing
@@ -223,12 +1146,24 @@ class TestUnfs(unittest.TestCase):
         outFile.close()
 
         end = time.time()
+
+        # read it back through the same path
+        readStart = time.time()
+        inFile = open(self.testBigFileDest, 'r')
+        while inFile.read(bufSize):
+            pass
+        inFile.close()
+        readEnd = time.time()
+
         os.unlink(self.testBigFileDest)
 
         timeTaken = float(end - start)
         mb = bytes/1024/1024
         mbs = bytes/1024/1024/float(end - start)
+        readMbs = bytes/1024/1024/float(readEnd - readStart)
+        print '%s MB: write %.1f MB/s, read %.1f MB/s' % (mb, mbs, readMbs)
         self.assert_(mbs > 10)
+        self.assert_(readMbs > 10)
 
     def testNodeDistrib(self):
         """
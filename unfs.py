@@ -6,100 +6,2935 @@ unfs.py mounts the UNFS filesystem to mountpoint and daemonizes.
 # ignore complaint about '*args **kwargs' magic.. :P
 # pylint: disable-msg=W0142
 
-import os, errno, random, fuse, time, logging, statvfs
+import os, errno, random, fuse, time, logging, statvfs, threading, Queue
+import ctypes, ctypes.util, select, sqlite3, stat, itertools, shutil
+import bisect, functools, json, types, tempfile, collections, signal, fcntl
+import optparse
+from collections import OrderedDict
 from fuse import Fuse
 
+# optional, os.listdir is used without it
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 # config
 try:
     base = os.path.split(os.sys.argv[1])[0]
     os.path.exists(base)
 
-    if base == '/':
-        base = ''
+    if base == '/':
+        base = ''
+
+    mountPoint = base + '/unfs'
+    nodeMountPoint = base + '/fs'
+except IndexError:
+    base = '/'
+    mountPoint = '/unfs'
+    nodeMountPoint = '/fs'
+
+fuse.fuse_python_api = (0, 2)
+logLevel = logging.CRITICAL
+unfsNodes = []
+unfsNodeLastUpdate = 0
+locationCacheSize = 10000
+negativeCacheSize = 10000
+negativeCacheTTL = 2.0
+fanoutPoolSize = 16
+fanoutNodeConcurrency = 4
+spaceRefreshInterval = 5.0
+nodePollInterval = 10.0
+indexPath = None
+indexCrawlInterval = 86400.0
+readdirBatch = 1024
+readdirCursorCount = 64
+sequentialThreshold = 3
+readaheadWindow = 8 * 1024 * 1024
+dropBehind = True
+fileVersionCount = 10000
+reservedPrefix = '.unfs-'
+rebalanceInterval = 0
+rebalanceThreshold = 0.05
+rebalanceBandwidth = 20 * 1024 * 1024
+rebalanceIOPS = 200
+rebalanceDryRun = 0
+stripeDirs = ''
+stripeSize = 4 * 1024 * 1024
+replicationFactor = 1
+replicationDirs = ''
+repairInterval = 0
+nodeStatsAlpha = 0.1
+nodeErrorLimit = 0.5
+nodeTimeout = 10.0
+breakerThreshold = 3
+breakerTick = 0.1
+probeInterval = 5.0
+statsDir = '/.unfs'
+latencyBuckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+    5.0, 10.0)
+traceRate = 0.0
+traceSize = 10000
+traceFile = '/tmp/unfs.trace'
+nodeDelays = ''
+writeBufferSize = 1024 * 1024
+writeBufferAge = 1.0
+placementPolicy = 'mostfree'
+placementDirs = ''
+placementReserve = 0.05
+writeReservation = 64 * 1024 * 1024
+tierNode = ''
+tierSize = 1024 * 1024 * 1024
+tierPromote = 16
+tierPolicy = 'lru'
+
+# mount options (-o name=value) that override the config globals above
+mountOptions = {
+    'cachesize': ('locationCacheSize', 'int',
+        'paths kept in the path-to-node cache'),
+    'negcachesize': ('negativeCacheSize', 'int',
+        'missing paths kept in the negative cache'),
+    'negcachettl': ('negativeCacheTTL', 'float',
+        'seconds a missing path stays cached'),
+    'poolsize': ('fanoutPoolSize', 'int',
+        'worker threads for per-node operations'),
+    'nodeconcurrency': ('fanoutNodeConcurrency', 'int',
+        'operations in flight per node'),
+    'spaceinterval': ('spaceRefreshInterval', 'float',
+        'seconds between free space samples of each node'),
+    'nodepoll': ('nodePollInterval', 'float',
+        'seconds between node rescans when inotify is unavailable'),
+    'index': ('indexPath', 'string',
+        'sqlite file keeping a persistent path-to-node index'),
+    'indexcrawl': ('indexCrawlInterval', 'float',
+        'seconds between full crawls refreshing the index, 0 for once'),
+    'readdirbatch': ('readdirBatch', 'int',
+        'entries read from each node per round of a listing'),
+    'seqthreshold': ('sequentialThreshold', 'int',
+        'back to back reads before a handle is treated as a stream'),
+    'readahead': ('readaheadWindow', 'int',
+        'bytes to prefetch ahead of a sequential reader'),
+    'dropbehind': ('dropBehind', 'int',
+        'drop backing pages behind a sequential reader (0 or 1)'),
+    'rebalance': ('rebalanceInterval', 'float',
+        'seconds between rebalancing passes, 0 to never rebalance'),
+    'rebalancethreshold': ('rebalanceThreshold', 'float',
+        'free fraction spread between nodes that triggers moves'),
+    'rebalancebw': ('rebalanceBandwidth', 'int',
+        'bytes per second the rebalancer may copy, 0 for no limit'),
+    'rebalanceiops': ('rebalanceIOPS', 'int',
+        'io operations per second the rebalancer may do, 0 for no limit'),
+    'rebalancedryrun': ('rebalanceDryRun', 'int',
+        'only log what the rebalancer would move (0 or 1)'),
+    'stripedirs': ('stripeDirs', 'string',
+        'comma separated dirs whose new files are striped over all nodes, '
+        'not replicated'),
+    'stripesize': ('stripeSize', 'int',
+        'bytes per chunk of a striped file'),
+    'replicas': ('replicationFactor', 'int',
+        'copies kept of every new file'),
+    'replicadirs': ('replicationDirs', 'string',
+        'comma separated dir:copies overriding replicas below dir'),
+    'repair': ('repairInterval', 'float',
+        'seconds between passes restoring missing replicas, 0 for never'),
+    'statsalpha': ('nodeStatsAlpha', 'float',
+        'weight of each new sample in the per node moving averages'),
+    'errorlimit': ('nodeErrorLimit', 'float',
+        'error rate above which a node is no longer preferred for reads'),
+    'nodetimeout': ('nodeTimeout', 'float',
+        'seconds before a node call counts as timed out, 0 for never'),
+    'breaker': ('breakerThreshold', 'int',
+        'timeouts in a row before a node is taken out of service'),
+    'probeinterval': ('probeInterval', 'float',
+        'seconds between probes of a node taken out of service'),
+    'tracerate': ('traceRate', 'float',
+        'fraction of operations traced, 0 for none and 1 for all'),
+    'tracesize': ('traceSize', 'int',
+        'traced operations and node calls kept in memory'),
+    'tracefile': ('traceFile', 'string',
+        'file the trace is written to on SIGUSR1'),
+    'writebuffer': ('writeBufferSize', 'int',
+        'bytes of adjacent writes gathered per open file, 0 to write through'),
+    'writeage': ('writeBufferAge', 'float',
+        'seconds buffered writes may wait before going to the node'),
+    'placement': ('placementPolicy', 'string',
+        'how new files pick a node: mostfree, roundrobin, fillfirst, parent '
+        'or weighted'),
+    'placementdirs': ('placementDirs', 'string',
+        'comma separated dir:policy overriding placement below dir'),
+    'placementreserve': ('placementReserve', 'float',
+        'free fraction below which fillfirst and parent move on to the '
+        'next node'),
+    'reservation': ('writeReservation', 'int',
+        'bytes placement counts as taken on a node for each file being '
+        'written there'),
+    'tiernode': ('tierNode', 'string',
+        'fast node often read files are copied to and read from, relative '
+        'to the node mount point unless absolute; none if empty'),
+    'tiersize': ('tierSize', 'int',
+        'bytes of copies kept on the tier node'),
+    'tierpromote': ('tierPromote', 'int',
+        'opens of a file for reading before it is copied to the tier node'),
+    'tierpolicy': ('tierPolicy', 'string',
+        'lru or lfu, which copies make room on the tier node'),
+    'nodedelay': ('nodeDelays', 'string',
+        'comma separated node:seconds slept before every call on node, '
+        'seconds alone for every node; for benchmarks'),
+}
+
+logging.basicConfig(level=logLevel, 
+    format='%(asctime)s %(levelname)s %(message)s',
+    filename='/tmp/unfs.log',
+)
+
+unfsNodesLock = threading.Lock()
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    libc = None
+
+# inotify events that can change the node list
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NODE_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# positional io, python 2 has no os.pread/os.pwrite
+libcPread = getattr(libc, 'pread64', None)
+libcPwrite = getattr(libc, 'pwrite64', None)
+for _func in (libcPread, libcPwrite):
+    if _func is not None:
+        _func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+            ctypes.c_int64]
+        _func.restype = ctypes.c_ssize_t
+seekLock = threading.Lock()
+
+# posix_fadvise advice
+POSIX_FADV_NORMAL = 0
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+libcFadvise = getattr(libc, 'posix_fadvise64', None)
+if libcFadvise is not None:
+    libcFadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+        ctypes.c_int]
+    libcFadvise.restype = ctypes.c_int
+
+class LocationCache(object):
+    """
+    Bounded LRU map of virtual path -> node that holds it.
+    Entries are only hints, callers verify them against the node.
+    """
+
+    def __init__(self, size):
+        """
+        Init empty cache holding at most size paths.
+        """
+
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Return cached node for path, or None. Marks path as recently used.
+        """
+
+        with self.lock:
+            try:
+                node = self.entries.pop(path)
+            except KeyError:
+                return None
+            self.entries[path] = node
+            return node
+
+    def set(self, path, node):
+        """
+        Remember that path lives on node, evicting the oldest entry if full.
+        """
+
+        with self.lock:
+            self.entries.pop(path, None)
+            self.entries[path] = node
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path, tree=False):
+        """
+        Forget path, and everything below it if tree is set.
+        """
+
+        with self.lock:
+            self.entries.pop(path, None)
+            if tree:
+                prefix = path.rstrip('/') + '/'
+                for cached in [p for p in self.entries if p.startswith(prefix)]:
+                    del self.entries[cached]
+
+    def pop(self, path):
+        """
+        Remove and return cached node for path, or None.
+        """
+
+        with self.lock:
+            return self.entries.pop(path, None)
+
+    def clear(self):
+        """
+        Forget everything, eg. when the node list changes.
+        """
+
+        with self.lock:
+            self.entries.clear()
+
+locationCache = LocationCache(locationCacheSize)
+
+# (path, offset) -> (name, rest of listing) for readdirs the kernel will resume
+readdirCursors = LocationCache(readdirCursorCount)
+
+# path -> (mtime, size) last seen by a handle, to tell the kernel when its
+# cached pages are still good
+fileVersions = LocationCache(fileVersionCount)
+
+class NegativeCache(object):
+    """
+    Bounded, time limited set of paths known not to exist on any node.
+    generation counts invalidations, so a lookup can tell one raced it.
+    """
+
+    def __init__(self, size, ttl):
+        """
+        Init empty cache holding at most size paths for ttl seconds each.
+        """
+
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def hit(self, path):
+        """
+        True if path was recently found missing everywhere.
+        """
+
+        with self.lock:
+            expires = self.entries.get(path)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self.entries[path]
+                return False
+            return True
+
+    def add(self, path, generation=None):
+        """
+        Remember that path is missing, evicting the oldest entry if full.
+        Nothing is added if generation is given and something was invalidated
+        since it was read, as the path may have been made meanwhile.
+        """
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries.pop(path, None)
+            self.entries[path] = time.time() + self.ttl
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path, tree=False):
+        """
+        Forget path, and everything below it if tree is set.
+        """
+
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(path, None)
+            if tree:
+                prefix = path.rstrip('/') + '/'
+                for cached in [p for p in self.entries if p.startswith(prefix)]:
+                    del self.entries[cached]
+
+    def clear(self):
+        """
+        Forget everything, eg. when the node list changes.
+        """
+
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+negativeCache = NegativeCache(negativeCacheSize, negativeCacheTTL)
+
+class Metrics(object):
+    """
+    Counters and latency histograms for the stats files in statsDir. Counters
+    are keyed by name and labels, histograms by operation name.
+    """
+
+    def __init__(self, buckets):
+        """
+        Init empty metrics, buckets being the upper bounds in seconds of the
+        latency histograms.
+        """
+
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, name, value, **labels):
+        """
+        Add value to counter name with labels.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def count(self, name, **labels):
+        """
+        Add one to counter name with labels.
+        """
+
+        self.add(name, 1, **labels)
+
+    def observe(self, op, seconds, err=None):
+        """
+        Record one call of op taking seconds, err being the errno it failed
+        with, if any.
+        """
+
+        with self.lock:
+            histogram = self.histograms.get(op)
+            if histogram is None:
+                histogram = self.histograms[op] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+        if err:
+            self.count('op_errors', op=op,
+                error=errno.errorcode.get(err, str(err)))
+
+    def snapshot(self):
+        """
+        Everything as a dict of plain types, histogram buckets cumulative
+        like prometheus has them.
+        """
+
+        with self.lock:
+            counters = self.counters.items()
+            histograms = [(op, list(histogram)) for op, histogram in \
+                self.histograms.iteritems()]
+
+        snap = {'uptime': time.time() - self.started, 'counters': {},
+            'ops': {}, 'caches': {}}
+        for (name, labels), value in sorted(counters):
+            snap['counters'].setdefault(name, []).append(
+                {'labels': dict(labels), 'value': value})
+            if name == 'cache_lookups':
+                labels = dict(labels)
+                cache = snap['caches'].setdefault(labels['cache'],
+                    {'hit': 0, 'miss': 0})
+                cache[labels['result']] += value
+
+        for cache in snap['caches'].itervalues():
+            cache['hitRate'] = cache['hit'] / float(cache['hit'] + \
+                cache['miss'] or 1)
+
+        for op, histogram in sorted(histograms):
+            buckets = []
+            total = 0
+            for bound, n in zip(self.buckets + ('+Inf',), histogram[:-1]):
+                total += n
+                buckets.append((bound, total))
+            snap['ops'][op] = {'count': total, 'sum': histogram[-1],
+                'buckets': buckets}
+        return snap
+
+    def json(self):
+        """
+        snapshot as JSON.
+        """
+
+        return json.dumps(self.snapshot(), indent=1, sort_keys=True) + '\n'
+
+    def prometheus(self):
+        """
+        snapshot in the prometheus text exposition format.
+        """
+
+        def labelText(labels):
+            """
+            {name="value",...} for a dict of labels.
+            """
+
+            if not labels:
+                return ''
+            return '{%s}' % ','.join(['%s="%s"' % (name,
+                str(value).replace('\\', '\\\\').replace('"', '\\"')) \
+                for name, value in sorted(labels.items())])
+
+        snap = self.snapshot()
+        lines = ['# TYPE unfs_uptime_seconds gauge',
+            'unfs_uptime_seconds %f' % snap['uptime']]
+        for name, samples in sorted(snap['counters'].items()):
+            lines.append('# TYPE unfs_%s_total counter' % name)
+            for sample in samples:
+                lines.append('unfs_%s_total%s %s' % (name,
+                    labelText(sample['labels']), sample['value']))
+
+        lines.append('# TYPE unfs_op_seconds histogram')
+        for op, histogram in sorted(snap['ops'].items()):
+            for bound, n in histogram['buckets']:
+                lines.append('unfs_op_seconds_bucket%s %d' % \
+                    (labelText({'op': op, 'le': bound}), n))
+            lines.append('unfs_op_seconds_sum%s %f' % \
+                (labelText({'op': op}), histogram['sum']))
+            lines.append('unfs_op_seconds_count%s %d' % \
+                (labelText({'op': op}), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(latencyBuckets)
+
+class Tracer(object):
+    """
+    Ring buffer of the last size operations and the node calls they made, as
+    (time, op, path, node, seconds, errno). A rate of the operations are
+    traced, chosen when they start; with rate 0 tracing costs a check of it.
+    Dumped to traceFile on SIGUSR1 and readable from statsDir.
+
+    Python handlers only run in the main thread, which sits in the fuse loop
+    for good, so the signal is only noted on a pipe through set_wakeup_fd
+    and a thread reading it does the dump.
+    """
+
+    def __init__(self, size, rate):
+        """
+        Init empty buffer of size entries tracing rate of operations.
+        """
+
+        self.rate = rate
+        self.entries = collections.deque(maxlen=size)
+        self.local = threading.local()
+        self.wakeup = None
+        self.thread = None
+
+    def listen(self):
+        """
+        Have SIGUSR1 written to a pipe for start's thread. Call from the main
+        thread, before the fuse loop.
+        """
+
+        if self.wakeup is not None:
+            return
+        r, w = os.pipe()
+        fcntl.fcntl(w, fcntl.F_SETFL,
+            fcntl.fcntl(w, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.signal(signal.SIGUSR1, lambda *_: None)
+        signal.set_wakeup_fd(w)
+        self.wakeup = r
+
+    def start(self):
+        """
+        Start the thread dumping on SIGUSR1, once daemonized.
+        """
+
+        if self.wakeup is not None and not self.thread:
+            self.thread = threading.Thread(target=self._run, name='tracer')
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def _run(self):
+        """
+        Dump once per batch of signals read off the pipe.
+        """
+
+        while True:
+            try:
+                os.read(self.wakeup, 64)
+            except OSError, why:
+                if why.errno == errno.EINTR:
+                    continue
+                logging.critical('trace signal pipe failed: %s', why)
+                return
+            self.dump()
+
+    def resize(self, size):
+        """
+        Keep at most size entries from now on, the newest if there are more.
+        """
+
+        self.entries = collections.deque(self.entries, maxlen=size)
+
+    def begin(self, op, path):
+        """
+        Start op on path in the calling thread. Returns whether it is traced.
+        """
+
+        sampled = self.rate >= 1 or random.random() < self.rate
+        self.local.op = sampled and (op, path)
+        return sampled
+
+    def end(self, op, path, seconds, err=None):
+        """
+        Record op on path finished for the calling thread.
+        """
+
+        self.local.op = None
+        self.entries.append((time.time(), op, path, None, seconds, err))
+
+    def context(self):
+        """
+        The calling thread's traced op, for handing to another thread.
+        """
+
+        return getattr(self.local, 'op', None)
+
+    def adopt(self, context):
+        """
+        Trace node calls in the calling thread as part of context, from
+        another thread's context. None to stop.
+        """
+
+        self.local.op = context
+
+    def node(self, node, seconds, err=None):
+        """
+        Record a call on node made by the calling thread's traced op, if any.
+        """
+
+        current = getattr(self.local, 'op', None)
+        if current:
+            self.entries.append((time.time(), current[0], current[1], node,
+                seconds, err))
+
+    def text(self):
+        """
+        Buffer as text, a line per entry, oldest first.
+        """
+
+        lines = []
+        for when, op, path, node, seconds, err in list(self.entries):
+            lines.append('%.6f %s %s %s %.6f %s' % (when, op, path or '-',
+                node or '-', seconds,
+                err and errno.errorcode.get(err, err) or '-'))
+        return '\n'.join(lines) + (lines and '\n' or '')
+
+    def dump(self):
+        """
+        Write the buffer to traceFile.
+        """
+
+        try:
+            f = open(traceFile, 'w')
+            f.write(self.text())
+            f.close()
+        except IOError, why:
+            logging.critical('trace dump to %s failed: %s', traceFile, why)
+
+tracer = Tracer(traceSize, traceRate)
+
+def measured(func):
+    """
+    Decorator timing a fuse method into metrics under its own name, and into
+    the trace if it is sampled. A negative int returned or an OSError/IOError
+    raised counts as an error; a generator is timed until it is used up.
+    """
+
+    op = func.__name__
+
+    def finished(path, start, traced, err=None):
+        """
+        Account for one call of op.
+        """
+
+        seconds = time.time() - start
+        metrics.observe(op, seconds, err)
+        if traced:
+            tracer.end(op, path, seconds, err)
+
+    def timedIter(path, start, traced, items):
+        """
+        Pass items through, finishing op once they run out.
+        """
+
+        err = None
+        try:
+            for item in items:
+                yield item
+        except (OSError, IOError), why:
+            err = why.errno
+            raise
+        finally:
+            finished(path, start, traced, err)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kw):
+        """
+        Call func, timing it.
+        """
+
+        traced = False
+        path = None
+        if tracer.rate:
+            path = getattr(self, 'virtualPath', (args or [None])[0])
+            traced = tracer.begin(op, path)
+        start = time.time()
+        try:
+            result = func(self, *args, **kw)
+        except (OSError, IOError), why:
+            finished(path, start, traced, why.errno)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return timedIter(path, start, traced, result)
+        err = None
+        if isinstance(result, int) and result < 0:
+            err = -result
+        finished(path, start, traced, err)
+        return result
+
+    return wrapper
+
+# name in statsDir -> renderer of its contents
+statsFiles = {'stats': metrics.json, 'stats.prom': metrics.prometheus,
+    'trace': tracer.text}
+
+def inStatsDir(path):
+    """
+    True if virtual path is statsDir or anything below it.
+    """
+
+    return path == statsDir or path.startswith(statsDir + '/')
+
+def statsContent(path):
+    """
+    Current contents of the stats file at virtual path, or None if path isn't
+    one.
+    """
+
+    if os.path.dirname(path) != statsDir:
+        return None
+    render = statsFiles.get(os.path.basename(path))
+    return render and render()
+
+def statsAttr(path):
+    """
+    Attributes of statsDir or a stats file in it, read only and owned by the
+    daemon, or None for any other path.
+    """
+
+    st = fuse.Stat()
+    st.st_ino = st.st_dev = 0
+    st.st_uid = os.getuid()
+    st.st_gid = os.getgid()
+    st.st_atime = st.st_mtime = st.st_ctime = int(time.time())
+    if path == statsDir:
+        st.st_mode = stat.S_IFDIR | 0555
+        st.st_nlink = 2
+        st.st_size = 0
+        return st
+
+    content = statsContent(path)
+    if content is None:
+        return None
+    st.st_mode = stat.S_IFREG | 0444
+    st.st_nlink = 1
+    st.st_size = len(content)
+    return st
+
+# errors that say something about the request, not the node
+BENIGN_ERRNOS = (errno.ENOENT, errno.ENOTDIR, errno.EEXIST, errno.ENOTEMPTY,
+    errno.EACCES, errno.EPERM, errno.EISDIR, errno.ENOSPC, errno.EXDEV)
+
+# node -> seconds slept before every call on it, '*' for any node
+injectedDelays = {}
+
+def parseNodeDelays():
+    """
+    Fill injectedDelays from nodeDelays, node names being relative to
+    nodeMountPoint.
+    """
+
+    injectedDelays.clear()
+    for entry in nodeDelays.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, seconds = entry.rpartition(':')
+        injectedDelays[name and nodeMountPoint + '/' + name or '*'] = \
+            float(seconds)
+
+def injectDelay(node):
+    """
+    Sleep as long as injectedDelays says calls on node should take.
+    """
+
+    if injectedDelays:
+        delay = injectedDelays.get(node, injectedDelays.get('*'))
+        if delay:
+            time.sleep(delay)
+
+class NodeStats(object):
+    """
+    Per node moving averages of call latency and error rate, fed by the
+    backend calls, and operations in flight. Used to send reads to the
+    fastest healthy node when several can serve them.
+    """
+
+    def __init__(self, alpha):
+        """
+        Init with no history, alpha being the weight of each new sample.
+        """
+
+        self.alpha = alpha
+        self.latency = {}
+        self.errors = {}
+        self.inFlight = {}
+        self.lock = threading.Lock()
+
+    def record(self, node, seconds, why=None):
+        """
+        Fold one call on node taking seconds into the averages, why being the
+        exception it raised, if any.
+        """
+
+        failed = why is not None and \
+            getattr(why, 'errno', None) not in BENIGN_ERRNOS
+        err = getattr(why, 'errno', None)
+        if why is None:
+            metrics.count('node_calls', node=node, result='ok')
+        else:
+            metrics.count('node_calls', node=node,
+                result=errno.errorcode.get(err, 'error'))
+        if tracer.rate:
+            tracer.node(node, seconds, err)
+        with self.lock:
+            latency = self.latency.get(node)
+            if latency is None:
+                self.latency[node] = seconds
+            else:
+                self.latency[node] = latency + self.alpha * (seconds - latency)
+            errors = self.errors.get(node, 0.0)
+            self.errors[node] = errors + self.alpha * (failed - errors)
+
+    def timed(self, node, func, *args):
+        """
+        Call func(*args) as a call on node, recording how it went.
+        """
+
+        token = breaker.begin(node)
+        start = time.time()
+        try:
+            injectDelay(node)
+            result = func(*args)
+        except (OSError, IOError), why:
+            self.record(node, time.time() - start, why)
+            raise
+        finally:
+            breaker.end(token)
+        self.record(node, time.time() - start)
+        return result
+
+    def healthy(self, node):
+        """
+        True unless node has been failing lately.
+        """
+
+        return self.errors.get(node, 0.0) < nodeErrorLimit
+
+    def _score(self, node):
+        """
+        Sort key, healthy nodes first, then by expected wait. Nodes without
+        history count as fast so they get tried.
+        """
+
+        return (not self.healthy(node),
+            self.latency.get(node, 0.0) * (self.inFlight.get(node, 0) + 1))
+
+    def rank(self, nodes):
+        """
+        nodes sorted fastest healthy first, keeping their order on ties.
+        """
+
+        with self.lock:
+            return sorted(nodes, key=self._score)
+
+    def pick(self, nodes):
+        """
+        Fastest healthy of nodes, marked busier. Hand it back with done when
+        finished.
+        """
+
+        with self.lock:
+            node = min(nodes, key=self._score)
+            self.inFlight[node] = self.inFlight.get(node, 0) + 1
+            return node
+
+    def done(self, node):
+        """
+        Operation on node from pick finished.
+        """
+
+        with self.lock:
+            self.inFlight[node] -= 1
+
+nodeStats = NodeStats(nodeStatsAlpha)
+
+class NodeBreaker(object):
+    """
+    Deadlines and circuit breaking for nodes, so one hung disk can't stall
+    the pool. Every backend call registers while it runs; a watchdog thread
+    counts calls running past nodeTimeout against their node and wakes fan
+    outs waiting past it. A node with breakerThreshold timeouts in a row is
+    degraded: skipped for lookups, listings and placement, and probed in the
+    background until it answers again.
+    """
+
+    def __init__(self):
+        """
+        Init with every node healthy and the watchdog stopped.
+        """
+
+        self.failures = {}
+        self.degraded = set()
+        self.probing = set()
+        self.calls = {}
+        self.waits = {}
+        self.tokens = itertools.count()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the watchdog thread, if it isn't running.
+        """
+
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run,
+                name='unfs-breaker')
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def begin(self, node):
+        """
+        Register a call on node. Returns a token for end.
+        """
+
+        token = self.tokens.next()
+        with self.lock:
+            self.calls[token] = [node, time.time(), False]
+        return token
+
+    def end(self, token):
+        """
+        Call from begin finished. One that made it in time resets its node's
+        run of timeouts.
+        """
+
+        with self.lock:
+            node, _, late = self.calls.pop(token)
+            if not late:
+                self.failures[node] = 0
+
+    def wait(self, queue, count):
+        """
+        Take count items off queue, giving up at nodeTimeout if the watchdog
+        is running. Returns whether all of them arrived.
+        """
+
+        if not nodeTimeout or not self.thread:
+            for _ in xrange(count):
+                queue.get()
+            return True
+
+        # python 2 timed waits poll, so the watchdog wakes us with a None
+        token = self.tokens.next()
+        with self.lock:
+            self.waits[token] = (time.time() + nodeTimeout, queue)
+        try:
+            for _ in xrange(count):
+                if queue.get() is None:
+                    return False
+            return True
+        finally:
+            with self.lock:
+                self.waits.pop(token, None)
+
+    def timedOut(self, node):
+        """
+        Count a timeout against node, degrading it after breakerThreshold.
+        """
+
+        nodeStats.record(node, nodeTimeout,
+            OSError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT)))
+        with self.lock:
+            self.failures[node] = self.failures.get(node, 0) + 1
+            if self.failures[node] < breakerThreshold or \
+                    node in self.degraded:
+                return
+            self.degraded.add(node)
+        logging.critical('node %s degraded after %d timeouts',
+            node, breakerThreshold)
+
+    def restore(self, node):
+        """
+        Put a degraded node back into service.
+        """
+
+        with self.lock:
+            self.degraded.discard(node)
+            self.failures[node] = 0
+        # misses seen while it was out may exist after all
+        negativeCache.clear()
+        logging.critical('node %s restored', node)
+
+    def live(self, nodes):
+        """
+        nodes without the degraded ones.
+        """
+
+        if not self.degraded:
+            return nodes
+        return [node for node in nodes if node not in self.degraded]
+
+    def isDegraded(self, node):
+        """
+        True if node is out of service.
+        """
+
+        return node in self.degraded
+
+    def _probe(self, node):
+        """
+        statvfs a degraded node in a thread of its own, restoring it if that
+        comes back in time.
+        """
+
+        start = time.time()
+        try:
+            os.statvfs(node)
+            if time.time() - start < nodeTimeout:
+                self.restore(node)
+        except OSError, why:
+            logging.debug('probe %s failed: %s', node, why)
+        finally:
+            with self.lock:
+                self.probing.discard(node)
+
+    def _run(self):
+        """
+        Enforce deadlines every breakerTick seconds, probe degraded nodes
+        every probeInterval.
+        """
+
+        lastProbe = time.time()
+        while True:
+            time.sleep(breakerTick)
+            now = time.time()
+            late = []
+            with self.lock:
+                for call in self.calls.itervalues():
+                    if not call[2] and now - call[1] > nodeTimeout:
+                        call[2] = True
+                        late.append(call[0])
+                for token, (deadline, queue) in self.waits.items():
+                    if deadline < now:
+                        del self.waits[token]
+                        queue.put(None)
+            for node in late:
+                self.timedOut(node)
+
+            if now - lastProbe < probeInterval:
+                continue
+            lastProbe = now
+            with self.lock:
+                probes = self.degraded - self.probing
+                self.probing |= probes
+            for node in probes:
+                t = threading.Thread(target=self._probe, args=(node,),
+                    name='unfs-probe')
+                t.setDaemon(True)
+                t.start()
+
+breaker = NodeBreaker()
+
+class NodePool(object):
+    """
+    Bounded pool of worker threads that runs one call per node at once, so
+    fan-out operations take as long as the slowest node, not the sum.
+    Threads are started on first use, after fuse has daemonized.
+    """
+
+    def __init__(self, size, nodeConcurrency):
+        """
+        Init pool of size workers, allowing nodeConcurrency calls per node.
+        """
+
+        self.size = size
+        self.nodeConcurrency = nodeConcurrency
+        self.jobs = Queue.Queue()
+        self.threads = []
+        self.nodeSlots = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _start(self):
+        """
+        Start worker threads if they aren't running yet.
+        """
+
+        with self.lock:
+            while len(self.threads) < self.size:
+                t = threading.Thread(target=self._worker,
+                    name='unfs-pool-%d' % len(self.threads))
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+
+    def _worker(self):
+        """
+        Run jobs forever.
+        """
+
+        self.local.worker = True
+        while True:
+            job = self.jobs.get()
+            job()
+
+    def _slot(self, node):
+        """
+        Semaphore limiting concurrent calls on node.
+        """
+
+        with self.lock:
+            slot = self.nodeSlots.get(node)
+            if slot is None:
+                slot = threading.Semaphore(self.nodeConcurrency)
+                self.nodeSlots[node] = slot
+            return slot
+
+    def _call(self, func, node):
+        """
+        Call func(node) within node's concurrency limit. Returns
+        (node, result, error).
+        """
+
+        slot = self._slot(node)
+        slot.acquire()
+        token = breaker.begin(node)
+        start = time.time()
+        try:
+            injectDelay(node)
+            result = func(node)
+            nodeStats.record(node, time.time() - start)
+            return node, result, None
+        # errors are handed back to the caller, never kill the worker
+        # pylint: disable-msg=W0703
+        except Exception, why:
+            nodeStats.record(node, time.time() - start, why)
+            return node, None, why
+        finally:
+            breaker.end(token)
+            slot.release()
+
+    def submit(self, func, node):
+        """
+        Call func(node) in the background, not waiting for it.
+        """
+
+        self._start()
+        self.jobs.put(lambda: self._call(func, node))
+
+    def map(self, func, nodes):
+        """
+        Call func(node) for each node in parallel. Returns a list of
+        (node, result, error) in node order, error being the exception func
+        raised or None. Calls still running at nodeTimeout are given up on
+        with ETIMEDOUT.
+        """
+
+        nodes = list(nodes)
+        # no point handing a single call over, and a worker waiting on its
+        # own pool could deadlock
+        if len(nodes) < 2 or self.size < 2 or \
+                getattr(self.local, 'worker', False):
+            return [self._call(func, node) for node in nodes]
+
+        self._start()
+        results = [None] * len(nodes)
+        done = Queue.Queue()
+        context = tracer.rate and tracer.context()
+
+        def job(i, node):
+            """
+            Run one call and report back.
+            """
+
+            if context:
+                tracer.adopt(context)
+            results[i] = self._call(func, node)
+            if context:
+                tracer.adopt(None)
+            done.put(i)
+
+        for i, node in enumerate(nodes):
+            self.jobs.put(lambda i=i, node=node: job(i, node))
+        if breaker.wait(done, len(nodes)):
+            return results
+
+        # late calls may still fill in results, so hand back a copy
+        finished = list(results)
+        for i, node in enumerate(nodes):
+            if finished[i] is None:
+                finished[i] = (node, None, OSError(errno.ETIMEDOUT,
+                    os.strerror(errno.ETIMEDOUT), node))
+        return finished
+
+nodePool = NodePool(fanoutPoolSize, fanoutNodeConcurrency)
+
+def fanOut(func, nodes=None):
+    """
+    Run func(node) on every node (default all unfsNodes) through nodePool.
+    Degraded nodes are left out of the default, and fail with EIO if asked
+    for by name.
+    """
+
+    if nodes is None:
+        return nodePool.map(func, breaker.live(unfsNodes))
+
+    live = breaker.live(nodes)
+    if len(live) == len(nodes):
+        return nodePool.map(func, nodes)
+
+    results = dict([(result[0], result) for result in \
+        nodePool.map(func, live)])
+    return [results.get(node) or (node, None, OSError(errno.EIO,
+        'node degraded', node)) for node in nodes]
+
+class SpaceMonitor(object):
+    """
+    Background sampler keeping a recent statvfs of every node, so placement
+    and statfs don't have to stat every node on every call.
+    """
+
+    def __init__(self, interval):
+        """
+        Init empty table, refreshed every interval seconds once started.
+        """
+
+        self.interval = interval
+        self.stats = {}
+        self.sampled = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the sampler thread, if it isn't running.
+        """
+
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run,
+                name='unfs-space')
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def _run(self):
+        """
+        Sample forever.
+        """
+
+        while True:
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self, nodes=None):
+        """
+        statvfs nodes (default all unfsNodes) now and swap in the new table.
+        Nodes that fail are kept as None so they aren't retried on every
+        lookup. Returns the new table.
+        """
+
+        stats = {}
+        for node, st, why in fanOut(os.statvfs, nodes):
+            if why:
+                logging.debug('statvfs %s failed: %s', node, why)
+            stats[node] = st
+
+        with self.lock:
+            self.stats = stats
+            self.sampled = time.time()
+        return stats
+
+    def table(self):
+        """
+        Return {node: statvfs} for every reachable node in unfsNodes.
+        Samples synchronously if the sampler is behind or a node is new.
+        """
+
+        nodes = unfsNodes
+        with self.lock:
+            stats, sampled = self.stats, self.sampled
+
+        if time.time() - sampled > 2 * self.interval or \
+                [node for node in nodes if node not in stats]:
+            stats = self.sample(nodes)
+
+        return dict((node, stats[node]) for node in nodes \
+            if stats.get(node) is not None)
+
+spaceMonitor = SpaceMonitor(spaceRefreshInterval)
+
+def indexText(name):
+    """
+    name as the unicode the index stores, bytes being taken as utf-8.
+    """
+
+    if isinstance(name, unicode):
+        return name
+    return name.decode('utf-8', 'replace')
+
+class NamespaceIndex(object):
+    """
+    Optional persistent index of virtual path -> (node, file type, size) in
+    sqlite, so a freshly started daemon knows where things live without
+    probing every node. Like LocationCache it only gives hints.
+
+    Built by a background crawl of every node, kept current by the UNFS
+    operations that change the namespace. Writes go through one writer
+    thread that batches commits; each reading thread has its own connection.
+    """
+
+    schema = [
+        'PRAGMA journal_mode=WAL',
+        'CREATE TABLE IF NOT EXISTS paths (path TEXT PRIMARY KEY, '
+            'node TEXT, type INTEGER, size INTEGER, seen INTEGER)',
+    ]
+
+    def __init__(self):
+        """
+        Init closed index, every method is a no-op until open is called.
+        """
+
+        self.path = None
+        self.writes = Queue.Queue()
+        self.local = threading.local()
+        self.generation = 0
+
+    def open(self, path, crawlInterval=None):
+        """
+        Open or create the index at path and start the writer thread, and the
+        crawler if crawlInterval is not None.
+        """
+
+        db = sqlite3.connect(path)
+        for sql in self.schema:
+            db.execute(sql)
+        self.generation = (db.execute('SELECT MAX(seen) FROM paths') \
+            .fetchone()[0] or 0) + 1
+        db.commit()
+        db.close()
+
+        self.path = path
+        logging.critical('namespace index %s, generation %s',
+            path, self.generation)
+
+        threads = [self._writer]
+        if crawlInterval is not None:
+            threads.append(lambda: self._crawler(crawlInterval))
+        for target in threads:
+            t = threading.Thread(target=target, name='unfs-index')
+            t.setDaemon(True)
+            t.start()
+
+    def _db(self):
+        """
+        Connection for the calling thread.
+        """
+
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path)
+        return db
+
+    def _writer(self):
+        """
+        Apply queued writes forever, committing whenever the queue runs dry
+        or every 1000 writes.
+        """
+
+        db = self._db()
+        while True:
+            sql, args = self.writes.get()
+            for written in xrange(1, 1001):
+                try:
+                    db.execute(sql, args)
+                except sqlite3.Error, why:
+                    logging.critical('index %s failed: %s', sql, why)
+                # a write taken off the queue has to go into this batch
+                if written == 1000:
+                    break
+                try:
+                    sql, args = self.writes.get_nowait()
+                except Queue.Empty:
+                    break
+            db.commit()
+
+    def _write(self, sql, *args):
+        """
+        Queue a write for the writer thread.
+        """
+
+        if self.path:
+            self.writes.put((sql, args))
+
+    def lookup(self, path):
+        """
+        Return the node path was last seen on, or None.
+        """
+
+        if not self.path:
+            return None
+
+        try:
+            row = self._db().execute('SELECT node FROM paths WHERE path = ?',
+                (indexText(path),)).fetchone()
+        except sqlite3.Error, why:
+            logging.debug('index lookup %s failed: %s', path, why)
+            return None
+
+        if row is None:
+            return None
+        return nodeMountPoint + '/' + row[0].encode('utf-8')
+
+    def add(self, path, node, mode, size=0):
+        """
+        Record path as living on node with the type bits of mode and size.
+        """
+
+        if not self.path:
+            return
+        self._write('INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?)',
+            indexText(path), indexText(os.path.basename(node)),
+            stat.S_IFMT(mode), size, self.generation)
+
+    def remove(self, path, tree=False):
+        """
+        Forget path, and everything below it if tree is set.
+        """
+
+        if not self.path:
+            return
+        path = indexText(path)
+        self._write('DELETE FROM paths WHERE path = ?', path)
+        if tree:
+            # everything below /a sorts between '/a/' and '/a0'
+            self._write('DELETE FROM paths WHERE path > ? AND path < ?',
+                path.rstrip('/') + '/', path.rstrip('/') + '0')
+
+    def rename(self, path, path1):
+        """
+        Move path and everything below it to path1.
+        """
+
+        if not self.path:
+            return
+        path = indexText(path).rstrip('/')
+        path1 = indexText(path1).rstrip('/')
+        self.remove(path1, tree=True)
+        self._write('UPDATE paths SET path = ? || SUBSTR(path, ?) '
+            'WHERE path = ? OR (path > ? AND path < ?)',
+            path1, len(path) + 1, path, path + '/', path + '0')
+
+    def crawl(self):
+        """
+        Walk every node and record what is there, the first node in unfsNodes
+        winning for paths on several. Rows not seen by a complete crawl are
+        dropped.
+        """
+
+        generation = self.generation
+        self.generation += 1
+        start = time.time()
+        logging.critical('index crawl %s starting', self.generation)
+
+        for node in unfsNodes:
+            nodeName = indexText(os.path.basename(node))
+            for dirPath, dirNames, fileNames in os.walk(node):
+                dirNames[:] = [d for d in dirNames if not isReserved(d)]
+                for name in dirNames + fileNames:
+                    realPath = os.path.join(dirPath, name)
+                    try:
+                        st = os.lstat(realPath)
+                    except OSError:
+                        continue
+                    path = indexText(realPath[len(node):])
+                    self._write('INSERT OR REPLACE INTO paths '
+                        'SELECT ?, ?, ?, ?, ? WHERE NOT EXISTS '
+                        '(SELECT 1 FROM paths WHERE path = ? AND seen = ?)',
+                        path, nodeName, stat.S_IFMT(st.st_mode), st.st_size,
+                        self.generation, path, self.generation)
+
+        self._write('DELETE FROM paths WHERE seen <= ?', generation)
+        logging.critical('index crawl %s done in %.1fs',
+            self.generation, time.time() - start)
+
+    def _crawler(self, interval):
+        """
+        Crawl now and then every interval seconds, or only once if 0.
+        """
+
+        while True:
+            try:
+                self.crawl()
+            except (OSError, IOError), why:
+                logging.critical('index crawl failed: %s', why)
+            if not interval:
+                return
+            time.sleep(interval)
+
+namespaceIndex = NamespaceIndex()
+
+optionTypes = {'int': int, 'float': float, 'string': str}
+
+def parseOptions(string, options=mountOptions):
+    """
+    Parse a comma separated -o string against options, a table like
+    mountOptions, for the tools mounting or reading a pool without fuse'
+    parser. Returns an optparse.Values holding those given by option name,
+    for applyMountOptions, and a list of the rest as they were written.
+    """
+
+    values = optparse.Values()
+    rest = []
+    for option in string.split(','):
+        name, _, value = option.partition('=')
+        if name in options:
+            setattr(values, name, optionTypes[options[name][1]](value))
+        elif option:
+            rest.append(option)
+    return values, rest
+
+def applyMountOptions(server):
+    """
+    Copy parsed mount options over the config globals and resize whatever was
+    built from them at import.
+    """
+
+    for opt, (name, _, _) in mountOptions.iteritems():
+        value = getattr(server, opt, None)
+        if value is not None:
+            globals()[name] = value
+
+    locationCache.size = locationCacheSize
+    readdirCursors.size = readdirCursorCount
+    fileVersions.size = fileVersionCount
+    negativeCache.size = negativeCacheSize
+    negativeCache.ttl = negativeCacheTTL
+    nodePool.size = fanoutPoolSize
+    nodePool.nodeConcurrency = fanoutNodeConcurrency
+    spaceMonitor.interval = spaceRefreshInterval
+    nodeStats.alpha = nodeStatsAlpha
+    parentNodes.size = locationCacheSize
+    tracer.rate = traceRate
+    tracer.resize(traceSize)
+    parseNodeDelays()
+
+def pathCreated(path, node=None, tree=False):
+    """
+    Update lookup caches after path was created, on node if it is known.
+    """
+
+    negativeCache.invalidate(path, tree)
+    if node is None:
+        locationCache.invalidate(path, tree)
+    else:
+        locationCache.set(path, node)
+
+def findNode(path, check=os.lstat):
+    """
+    Find the node holding path. check is called with the real path on each
+    node until it doesn't raise OSError. Returns (node, check result), or
+    (None, None) if no node has it. A cache hit costs one check on one node,
+    a recent miss costs nothing.
+    """
+
+    if negativeCache.hit(path):
+        metrics.count('cache_lookups', cache='negative', result='hit')
+        return None, None
+    metrics.count('cache_lookups', cache='negative', result='miss')
+    generation = negativeCache.generation
+
+    node = locationCache.get(path)
+    if node is not None and not breaker.isDegraded(node):
+        try:
+            result = nodeStats.timed(node, check, node + path)
+            metrics.count('cache_lookups', cache='location', result='hit')
+            return node, result
+        except OSError:
+            locationCache.invalidate(path)
+    metrics.count('cache_lookups', cache='location', result='miss')
+
+    node = namespaceIndex.lookup(path)
+    if node is not None and not breaker.isDegraded(node):
+        try:
+            result = nodeStats.timed(node, check, node + path)
+            locationCache.set(path, node)
+            metrics.count('cache_lookups', cache='index', result='hit')
+            return node, result
+        except OSError:
+            pass
+    if namespaceIndex.path:
+        metrics.count('cache_lookups', cache='index', result='miss')
+
+    # the first node wins for a path on several, as crawls and unfsfsck
+    # assume; only copies of a replicated path may come from the fastest
+    nodes = breaker.live(unfsNodes)
+    if replicaCount(path) > 1:
+        nodes = nodeStats.rank(nodes)
+    missing = True
+    for node in nodes:
+        try:
+            result = nodeStats.timed(node, check, node + path)
+        except OSError, why:
+            missing &= why.errno in (errno.ENOENT, errno.ENOTDIR)
+            continue
+        locationCache.set(path, node)
+        if check is os.lstat:
+            namespaceIndex.add(path, node, result.st_mode, result.st_size)
+        return node, result
+
+    # only an lstat miss means the path itself is gone; stat can miss on a
+    # dangling symlink and access on permissions
+    if missing and check is os.lstat:
+        negativeCache.add(path, generation)
+
+    return None, None
+
+def iterDir(path):
+    """
+    Iterate over the names in real directory path, lazily if scandir is
+    available.
+    """
+
+    if scandir is None:
+        return iter(os.listdir(path))
+    return (entry.name for entry in scandir(path))
+
+def listDir(path):
+    """
+    Stream the names in virtual directory path, merged over every node without
+    duplicates. Each round reads the next readdirBatch names from every node
+    still listing, in parallel; names come out in node order within a round,
+    so the order is stable for a directory that doesn't change.
+    """
+
+    nodes = unfsNodes
+    streams = {}
+    for node, names, why in fanOut(lambda node: iterDir(node + path), nodes):
+        if why:
+            logging.debug('readdir %s%s failed: %s', node, path, why)
+        else:
+            streams[node] = names
+
+    seen = set()
+    while streams:
+        active = [node for node in nodes if node in streams]
+        for node, names, why in fanOut(
+                lambda node: list(itertools.islice(streams[node],
+                    readdirBatch)), active):
+            if why:
+                logging.debug('readdir %s%s failed: %s', node, path, why)
+            if why or not names:
+                del streams[node]
+                continue
+            for name in names:
+                if name not in seen and not isReserved(name):
+                    seen.add(name)
+                    yield name
+
+def pread(fd, length, offset):
+    """
+    Read up to length bytes at offset from fd, without using or moving the fd
+    offset. Falls back to a locked seek and read without libc.
+    """
+
+    if libcPread is None:
+        with seekLock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+    buf = ctypes.create_string_buffer(length)
+    while True:
+        got = libcPread(fd, buf, length, offset)
+        if got >= 0:
+            return buf.raw[:got]
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+def pwrite(fd, data, offset):
+    """
+    Write all of data at offset to fd, without using or moving the fd offset.
+    Falls back to a locked seek and write without libc. Returns len(data).
+    """
+
+    if libcPwrite is None:
+        with seekLock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            done = 0
+            while done < len(data):
+                done += os.write(fd, data[done:])
+            return done
+
+    done = 0
+    while done < len(data):
+        chunk = data[done:]
+        wrote = libcPwrite(fd, chunk, len(chunk), offset + done)
+        if wrote < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            raise OSError(err, os.strerror(err))
+        done += wrote
+    return done
+
+def fadvise(fd, offset, length, advice):
+    """
+    posix_fadvise on fd. Only a hint, so failures are logged and ignored.
+    """
+
+    if libcFadvise is None:
+        return
+    err = libcFadvise(fd, offset, length, advice)
+    if err:
+        logging.debug('fadvise %s %s+%s %s failed: %s',
+            fd, offset, length, advice, os.strerror(err))
+
+def makeParents(node, path):
+    """
+    Make the missing parent dirs of virtual path on node, copying their mode
+    from whichever node already has them.
+    """
+
+    parent = os.path.dirname(path)
+    if parent == '/' or os.path.isdir(node + parent):
+        return
+
+    makeParents(node, parent)
+    _, st = findNode(parent)
+    mode = st and stat.S_IMODE(st.st_mode) or 0755
+    try:
+        os.mkdir(node + parent, mode)
+    except OSError, why:
+        if why.errno != errno.EEXIST:
+            raise
+
+def checkAccess(path, mode):
+    """
+    os.access that raises OSError on failure, for use with findNode.
+    """
+
+    if not os.access(path, mode):
+        raise OSError(errno.EACCES, os.strerror(errno.EACCES), path)
+
+def flag2mode(flags):
+    """
+    Rewrite flags to mode list
+    """
+
+    md = {
+        os.O_RDONLY:'r',
+        os.O_WRONLY:'w',
+        os.O_RDWR:'w+'
+    }
+    m = md[flags & (os.O_RDONLY | os.O_WRONLY | os.O_RDWR)]
+
+    if flags | os.O_APPEND:
+        m = m.replace('w', 'a', 1)
+
+    return m
+
+# called without arguments after the node list changed, eg. to drop caches
+# the kernel keeps
+nodeListeners = []
+
+def findNewNodes(remounted=False):
+    """
+    Loop through nodeMountPoint to find all nodes mounted, and swap the new
+    list in. Cached lookups are dropped if the list changed, or if remounted
+    says something may have been mounted over an existing node.
+    """
+
+    # ignore global warning for clarity
+    # pylint: disable-msg=W0603
+    global unfsNodes, unfsNodeLastUpdate
+
+    with unfsNodesLock:
+        nodes = []
+        for node in os.listdir(nodeMountPoint):
+            nodes.append(nodeMountPoint + '/' + node)
+
+        changed = nodes != unfsNodes or remounted
+        if changed:
+            logging.critical('nodes in %s: %s', nodeMountPoint, nodes)
+            locationCache.clear()
+            negativeCache.clear()
+
+        # readers take their own reference, so a plain swap is atomic to them
+        unfsNodes = nodes
+        unfsNodeLastUpdate = time.time()
+
+    if changed:
+        for listener in nodeListeners:
+            listener()
+
+class NodeWatcher(object):
+    """
+    Keeps unfsNodes current from inotify events on nodeMountPoint and changes
+    to the mount table, falling back to polling if those aren't available.
+    """
+
+    def __init__(self):
+        """
+        Init stopped watcher.
+        """
+
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the watcher thread, if it isn't running.
+        """
+
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run,
+                name='unfs-nodes')
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def _run(self):
+        """
+        Watch for events, or poll if that fails.
+        """
+
+        try:
+            self._watch()
+        except (OSError, IOError, AttributeError), why:
+            logging.critical('no node events, polling every %ss: %s',
+                nodePollInterval, why)
+
+        while True:
+            time.sleep(nodePollInterval)
+            try:
+                findNewNodes()
+            except OSError, why:
+                logging.critical('finding nodes failed: %s', why)
+
+    def _watch(self):
+        """
+        Rescan nodes whenever nodeMountPoint or the mount table changes.
+        Only returns by raising.
+        """
+
+        fd = libc.inotify_init()
+        if fd < 0 or libc.inotify_add_watch(fd, nodeMountPoint,
+                IN_NODE_EVENTS) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), nodeMountPoint)
+
+        # the kernel flags /proc/self/mounts with POLLPRI on every change
+        mounts = open('/proc/self/mounts', 'r')
+        mounts.read()
+
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        poller.register(mounts.fileno(), select.POLLPRI | select.POLLERR)
+
+        # catch anything that changed before the watches were in place
+        findNewNodes()
+        while True:
+            remounted = False
+            for eventFd, _ in poller.poll():
+                if eventFd == fd:
+                    os.read(fd, 4096)
+                else:
+                    mounts.seek(0)
+                    mounts.read()
+                    remounted = True
+            findNewNodes(remounted)
+
+nodeWatcher = NodeWatcher()
+
+def stripeDir(path):
+    """
+    Reserved dir holding the layout and chunks of striped virtual path, on
+    every node that has a piece of it.
+    """
+
+    dirName, baseName = os.path.split(path)
+    return os.path.join(dirName, reservedPrefix + 'stripe.' + baseName)
+
+def isStriped(path):
+    """
+    True if new files at virtual path get a striped layout.
+    """
+
+    for prefix in stripeDirs.split(','):
+        prefix = prefix.strip().rstrip('/')
+        if prefix and (path + '/').startswith(prefix + '/'):
+            return True
+    return False
+
+def removeStripe(node, path):
+    """
+    Remove the stripe dir of virtual path from node, if there is one.
+    """
+
+    sideDir = node + stripeDir(path)
+    if os.path.isdir(sideDir):
+        shutil.rmtree(sideDir)
+
+def trimStripe(node, path, length):
+    """
+    Cut the chunks of striped virtual path on node down to length bytes of
+    the whole file, so a later extension reads back zeros.
+    """
+
+    sideDir = node + stripeDir(path)
+    try:
+        stripe = Stripe.load(node, path)
+        names = os.listdir(sideDir)
+    except (OSError, IOError):
+        return
+
+    for name in names:
+        if not name.isdigit():
+            continue
+        start = int(name) * stripe.size
+        if start >= length:
+            os.unlink(sideDir + '/' + name)
+        elif start + stripe.size > length:
+            f = open(sideDir + '/' + name, 'r+')
+            f.truncate(length - start)
+            f.close()
+
+class Stripe(object):
+    """
+    Layout of a striped file. The file itself is a sparse manifest on the
+    first node, sized to the logical size so getattr needs nothing special.
+    Chunk i of size bytes lives on nodes[i % len(nodes)] in stripeDir(path),
+    and every node with a stripe dir keeps a copy of the layout there.
+    """
+
+    def __init__(self, path, size, nodes):
+        """
+        Init layout for virtual path of size byte chunks over node names.
+        """
+
+        self.path = path
+        self.size = size
+        self.nodes = nodes
+
+    @classmethod
+    def load(cls, node, path):
+        """
+        Read the layout of path from node. Raises IOError if path isn't
+        striped there.
+        """
+
+        fp = open(node + stripeDir(path) + '/layout', 'r')
+        try:
+            lines = fp.read().split('\n')
+        finally:
+            fp.close()
+        return cls(path, int(lines[0]), [line for line in lines[1:] if line])
+
+    @classmethod
+    def create(cls, path, nodes):
+        """
+        Lay path out over nodes, first one holding the manifest.
+        """
+
+        stripe = cls(path, stripeSize,
+            [os.path.basename(node) for node in nodes])
+        stripe.writeLayout(nodes[0])
+        return stripe
+
+    def writeLayout(self, node):
+        """
+        Make the stripe dir on node and write the layout into it.
+        """
+
+        sideDir = node + stripeDir(self.path)
+        makeParents(node, stripeDir(self.path) + '/layout')
+        fp = open(sideDir + '/layout', 'w')
+        try:
+            fp.write('%d\n%s\n' % (self.size, '\n'.join(self.nodes)))
+        finally:
+            fp.close()
+
+    def chunkNode(self, i):
+        """
+        Node holding chunk i.
+        """
+
+        return nodeMountPoint + '/' + self.nodes[i % len(self.nodes)]
+
+    def chunkPath(self, i):
+        """
+        Real path of chunk i.
+        """
+
+        return self.chunkNode(i) + stripeDir(self.path) + '/%d' % i
+
+    def pieces(self, offset, length):
+        """
+        Split a byte range into (chunk, offset in chunk, length, offset in
+        range) pieces.
+        """
+
+        done = 0
+        while done < length:
+            i, chunkOffset = divmod(offset + done, self.size)
+            pieceLength = min(self.size - chunkOffset, length - done)
+            yield i, chunkOffset, pieceLength, done
+            done += pieceLength
+
+    def byNode(self, pieces):
+        """
+        Group pieces by the node holding their chunk.
+        """
+
+        nodes = {}
+        for piece in pieces:
+            nodes.setdefault(self.chunkNode(piece[0]), []).append(piece)
+        return nodes
+
+class OpenFiles(object):
+    """
+    Open UnfsFile handles per virtual path. Background movers take the lock
+    while they swap a file, opens register before looking the path up, so an
+    open either sees the old node before the swap starts or the new one after
+    it is done. Renames carry the handles along to the new path.
+    """
+
+    def __init__(self):
+        """
+        Init with nothing open.
+        """
+
+        self.handles = {}
+        self.lock = threading.Lock()
+
+    def opened(self, handle):
+        """
+        Register handle, on its virtualPath.
+        """
+
+        with self.lock:
+            self.handles.setdefault(handle.virtualPath, []).append(handle)
+
+    def closed(self, handle):
+        """
+        Drop handle.
+        """
+
+        with self.lock:
+            handles = self.handles.get(handle.virtualPath, [])
+            if handle in handles:
+                handles.remove(handle)
+            if not handles:
+                self.handles.pop(handle.virtualPath, None)
+
+    def renamed(self, path, path1):
+        """
+        Move the handles on path, and on everything below it, to path1.
+        """
+
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            for old in [p for p in self.handles \
+                    if p == path or p.startswith(prefix)]:
+                new = path1 + old[len(path):]
+                for handle in self.handles.pop(old):
+                    handle.virtualPath = new
+                    self.handles.setdefault(new, []).append(handle)
+
+    def count(self, path):
+        """
+        Number of handles open on path.
+        """
+
+        return len(self.handles.get(path, ()))
+
+    def isOpen(self, path):
+        """
+        True if any handle on path is open. Callers wanting the answer to
+        hold should have the lock.
+        """
+
+        return path in self.handles
+
+openFiles = OpenFiles()
+
+class WriteBack(object):
+    """
+    Open files holding buffered writes, see UnfsFile.write. A background
+    thread pushes buffers older than writeBufferAge, and lookups of a path
+    push those of its handles first so sizes never go backwards.
+    """
+
+    def __init__(self):
+        """
+        Init with nothing buffered and no thread.
+        """
+
+        self.handles = set()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def dirty(self, handle):
+        """
+        handle started buffering. Starts the thread on first use, after fuse
+        has daemonized.
+        """
+
+        with self.lock:
+            self.handles.add(handle)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                    name='unfs-writeback')
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def clean(self, handle):
+        """
+        handle has nothing buffered any more.
+        """
+
+        with self.lock:
+            self.handles.discard(handle)
+
+    def flushPath(self, path):
+        """
+        Push the buffers of every handle on virtual path.
+        """
+
+        with self.lock:
+            handles = [h for h in self.handles if h.virtualPath == path]
+        for handle in handles:
+            handle.flushBuffer()
+
+    def _run(self):
+        """
+        Push old buffers forever.
+        """
+
+        while True:
+            time.sleep(max(writeBufferAge / 2, 0.01))
+            with self.lock:
+                handles = list(self.handles)
+            now = time.time()
+            for handle in handles:
+                if handle.bufferSince + writeBufferAge <= now:
+                    handle.flushBuffer()
+
+writeBack = WriteBack()
+
+def isReserved(name):
+    """
+    True for names unfs keeps for itself on the nodes, hidden from listings.
+    """
+
+    return name.startswith(reservedPrefix)
+
+class Throttle(object):
+    """
+    Sleeps just enough to keep to a bandwidth and an operation rate.
+    """
+
+    def __init__(self, bandwidth, iops):
+        """
+        Init throttle for bandwidth bytes and iops operations per second,
+        either being 0 for no limit.
+        """
+
+        self.bandwidth = bandwidth
+        self.iops = iops
+        self.start = time.time()
+        self.bytes = 0
+        self.ops = 0
+
+    def __call__(self, length):
+        """
+        Account one operation of length bytes, sleeping if ahead of the rate.
+        """
+
+        self.bytes += length
+        self.ops += 1
+        due = 0
+        if self.bandwidth:
+            due = max(due, float(self.bytes) / self.bandwidth)
+        if self.iops:
+            due = max(due, float(self.ops) / self.iops)
+        ahead = due - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+def copyToNode(path, src, dst, throttle=None, bufSize=1024 * 1024):
+    """
+    Copy virtual path from node src to a reserved temp name on node dst,
+    with mode, ownership and times. Returns the temp path; the caller renames
+    it into place or removes it.
+    """
+
+    dirName, baseName = os.path.split(path)
+    makeParents(dst, path)
+    tmpPath = '%s%s/%smove.%s' % (dst, dirName.rstrip('/'), reservedPrefix,
+        baseName)
+
+    srcFd = os.open(src + path, os.O_RDONLY)
+    try:
+        st = os.fstat(srcFd)
+        dstFd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            stat.S_IMODE(st.st_mode))
+        try:
+            offset = 0
+            while True:
+                buf = pread(srcFd, bufSize, offset)
+                if not buf:
+                    break
+                pwrite(dstFd, buf, offset)
+                offset += len(buf)
+                if throttle:
+                    throttle(len(buf))
+            os.fsync(dstFd)
+        finally:
+            os.close(dstFd)
+    except (OSError, IOError):
+        try:
+            os.unlink(tmpPath)
+        except OSError:
+            pass
+        raise
+    finally:
+        os.close(srcFd)
+
+    try:
+        os.chown(tmpPath, st.st_uid, st.st_gid)
+    except OSError, why:
+        logging.debug('chown %s failed: %s', tmpPath, why)
+    os.utime(tmpPath, (st.st_atime, st.st_mtime))
+    return tmpPath
+
+def freeBytes(st):
+    """
+    Bytes free to users in statvfs result st.
+    """
+
+    return st[statvfs.F_BAVAIL] * st[statvfs.F_BSIZE]
+
+def freeFraction(st):
+    """
+    Fraction of the node of statvfs result st that is free to users.
+    """
+
+    return float(st[statvfs.F_BAVAIL]) / max(st[statvfs.F_BLOCKS], 1)
+
+def placeMostFree(path, table):
+    """
+    Most free space first, random order if they are all equal.
+    """
+
+    nodes = table.keys()
+    random.shuffle(nodes)
+    # if all are equal, force a random choice
+    if len(set([freeBytes(st) for st in table.values()])) > 1:
+        nodes.sort(key=lambda node: freeBytes(table[node]), reverse=True)
+    return nodes
+
+placementTurn = itertools.count()
+
+def placeRoundRobin(path, table):
+    """
+    Each node in turn.
+    """
+
+    nodes = sorted(table)
+    turn = placementTurn.next() % len(nodes)
+    return nodes[turn:] + nodes[:turn]
+
+def placeFillFirst(path, table):
+    """
+    Nodes in name order, passing over those with no more than
+    placementReserve free, so one disk fills up before the next spins up.
+    """
+
+    nodes = [node for node in sorted(table) \
+        if freeFraction(table[node]) > placementReserve]
+    return nodes + placeMostFree(path, dict([(node, st) for node, st in \
+        table.iteritems() if node not in nodes]))
+
+# dir -> node its last new file went to, see placeParent
+parentNodes = LocationCache(locationCacheSize)
+
+def placeParent(path, table):
+    """
+    The node new files in the same dir went to, or else a node already
+    holding something there, so a dir's files stay on one disk. Most free
+    first when there is none, or that node has no more than
+    placementReserve free.
+    """
+
+    nodes = placeMostFree(path, table)
+    if path is None:
+        return nodes
+
+    parent = os.path.dirname(path)
+    node = parentNodes.get(parent)
+    if node not in table:
+        node = None
+        for candidate in nodes:
+            try:
+                names = iterDir(candidate + parent)
+            except OSError:
+                continue
+            for name in names:
+                if not isReserved(name):
+                    node = candidate
+                    break
+            if node:
+                break
+
+    if node and freeFraction(table[node]) > placementReserve:
+        nodes.remove(node)
+        nodes.insert(0, node)
+    parentNodes.set(parent, nodes[0])
+    return nodes
+
+def placeWeighted(path, table):
+    """
+    Random order weighted by free space, so fuller nodes still get a share.
+    """
+
+    weights = dict([(node, freeBytes(st)) for node, st in table.iteritems()])
+    nodes = []
+    while weights:
+        pick = random.uniform(0, sum(weights.values()))
+        for node, weight in weights.items():
+            pick -= weight
+            if pick <= 0:
+                break
+        nodes.append(node)
+        del weights[node]
+    return nodes
+
+# placement policy name -> policy(virtual path or None, {node: statvfs})
+# returning the nodes in the order new files should go to them
+placementPolicies = {
+    'mostfree': placeMostFree,
+    'roundrobin': placeRoundRobin,
+    'fillfirst': placeFillFirst,
+    'parent': placeParent,
+    'weighted': placeWeighted,
+}
+
+def placementPolicyFor(path):
+    """
+    Name of the placement policy for new files at virtual path.
+    """
+
+    best, name = '', placementPolicy
+    if path is None:
+        return name
+    for entry in placementDirs.split(','):
+        if ':' not in entry:
+            continue
+        prefix, dirPolicy = entry.rsplit(':', 1)
+        prefix = prefix.strip().rstrip('/')
+        if (path + '/').startswith(prefix + '/') and len(prefix) >= len(best):
+            best, name = prefix, dirPolicy.strip()
+    return name
+
+class SpaceReservations(object):
+    """
+    Bytes promised to files being written, per node. statvfs samples lag
+    behind writes, so placement counts these as used to keep creates racing
+    each other from all picking the node that looked emptiest.
+    """
+
+    def __init__(self):
+        """
+        Init with nothing reserved.
+        """
+
+        self.reserved = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, node, size):
+        """
+        Reserve size bytes on node.
+        """
+
+        with self.lock:
+            self.reserved[node] = self.reserved.get(node, 0) + size
+
+    def release(self, node, size):
+        """
+        Give back size bytes reserved on node.
+        """
+
+        with self.lock:
+            left = self.reserved.get(node, 0) - size
+            if left > 0:
+                self.reserved[node] = left
+            else:
+                self.reserved.pop(node, None)
+
+    def adjust(self, node, st):
+        """
+        statvfs result st of node with the bytes reserved there taken off
+        its free space.
+        """
+
+        reserved = self.reserved.get(node)
+        if not reserved:
+            return st
+        st = list(st)
+        blocks = reserved // max(st[statvfs.F_BSIZE], 1)
+        st[statvfs.F_BFREE] = max(0, st[statvfs.F_BFREE] - blocks)
+        st[statvfs.F_BAVAIL] = max(0, st[statvfs.F_BAVAIL] - blocks)
+        return tuple(st)
+
+spaceReservations = SpaceReservations()
+
+placementLock = threading.Lock()
+
+def placeNodes(count=1, exclude=(), path=None, reserve=0):
+    """
+    Picks count nodes to write virtual path to, leaving out exclude and
+    degraded nodes, in the order its placement policy prefers them. An
+    unknown policy counts as mostfree. Free space is net of reservations,
+    and reserve bytes are reserved on each node picked.
+    """
+
+    name = placementPolicyFor(path)
+    if name not in placementPolicies:
+        name = 'mostfree'
+    policy = placementPolicies[name]
+
+    # one placement at a time, creates racing each other see the same table
+    with placementLock:
+        table = {}
+        for node, st in spaceMonitor.table().iteritems():
+            if node not in exclude and not breaker.isDegraded(node):
+                table[node] = spaceReservations.adjust(node, st)
+
+        if table:
+            nodes = policy(path, table)
+        else:
+            nodes = [node for node in breaker.live(unfsNodes) \
+                if node not in exclude]
+            random.shuffle(nodes)
+
+        logging.debug('best nodes for %s (%s): %s', path, name, nodes[:count])
+        for node in nodes[:count]:
+            metrics.count('placements', node=node, policy=name)
+            if reserve:
+                spaceReservations.reserve(node, reserve)
+        return nodes[:count]
+
+def unfsRandom(path=None):
+    """
+    Picks the best (not random) node to write virtual path to.
+    """
+
+    return placeNodes(path=path)[0]
+
+def replicaCount(path):
+    """
+    Number of copies new files at virtual path should have. Striped files
+    are spread instead of copied, so get one.
+    """
+
+    if isStriped(path):
+        return 1
+    best, count = '', replicationFactor
+    for entry in replicationDirs.split(','):
+        if ':' not in entry:
+            continue
+        prefix, dirCount = entry.rsplit(':', 1)
+        prefix = prefix.strip().rstrip('/')
+        if (path + '/').startswith(prefix + '/') and len(prefix) >= len(best):
+            best, count = prefix, int(dirCount)
+    return max(1, min(count, len(unfsNodes)))
+
+def findReplicas(path):
+    """
+    Every node holding virtual path, in unfsNodes order.
+    """
+
+    return [node for node, _, why in fanOut(lambda node: os.lstat(node + path))
+        if not why]
+
+class Repairer(object):
+    """
+    Background pass putting back missing replicas: walks every node, counts
+    the copies of each regular file, and copies files short of their
+    replicaCount to the best nodes that don't have them.
+    """
+
+    def __init__(self):
+        """
+        Init stopped repairer.
+        """
+
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the repair thread, if it isn't running.
+        """
+
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run,
+                name='unfs-repair')
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def _run(self):
+        """
+        Repair every repairInterval seconds.
+        """
+
+        while True:
+            time.sleep(repairInterval)
+            try:
+                self.repair()
+            except (OSError, IOError), why:
+                logging.critical('repair failed: %s', why)
+
+    def missing(self):
+        """
+        Yield (path, nodes holding it, copies wanted) for short files,
+        leaving out the manifests of striped files.
+        """
+
+        holders = {}
+        for node in unfsNodes:
+            for dirPath, dirNames, fileNames in os.walk(node):
+                dirNames[:] = [d for d in dirNames if not isReserved(d)]
+                for name in fileNames:
+                    realPath = os.path.join(dirPath, name)
+                    if isReserved(name) or not os.path.isfile(realPath) or \
+                            os.path.islink(realPath):
+                        continue
+                    holders.setdefault(realPath[len(node):], []).append(node)
+
+        for path, nodes in holders.iteritems():
+            wanted = replicaCount(path)
+            if len(nodes) < wanted and not [node for node in nodes \
+                    if os.path.isdir(node + stripeDir(path))]:
+                yield path, nodes, wanted
+
+    def repair(self):
+        """
+        Copy every short file to as many new nodes as it needs.
+        """
+
+        repaired = 0
+        for path, nodes, wanted in self.missing():
+            if openFiles.isOpen(path):
+                continue
+            for dst in placeNodes(wanted - len(nodes), exclude=nodes,
+                    path=path):
+                try:
+                    tmpPath = copyToNode(path, nodes[0], dst)
+                    os.rename(tmpPath, dst + path)
+                    repaired += 1
+                except (OSError, IOError), why:
+                    logging.critical('repair %s on %s failed: %s',
+                        path, dst, why)
+        if repaired:
+            logging.critical('repair: %d replicas restored', repaired)
+
+repairer = Repairer()
+
+class Rebalancer(object):
+    """
+    Background mover evening out free space between nodes, since placement
+    only happens at create time. Each pass moves files from the fullest node
+    to the emptiest until their free fractions meet, throttled, skipping open
+    files. A file is copied to a temp name on the target, renamed into place,
+    and only then removed from the source, so it is never missing.
+    """
+
+    def __init__(self):
+        """
+        Init stopped rebalancer.
+        """
+
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the rebalancer thread, if it isn't running.
+        """
+
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run,
+                name='unfs-rebalance')
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def _run(self):
+        """
+        Rebalance every rebalanceInterval seconds.
+        """
+
+        while True:
+            time.sleep(rebalanceInterval)
+            try:
+                self.rebalance()
+            except (OSError, IOError), why:
+                logging.critical('rebalance failed: %s', why)
+
+    def rebalance(self):
+        """
+        One pass: plan, log the plan and carry it out, unless rebalanceDryRun
+        is set. Returns the report.
+        """
+
+        plan = self.plan()
+        report = self.report(plan)
+        logging.critical(report)
+        if not rebalanceDryRun:
+            self.run(plan)
+        return report
+
+    def plan(self):
+        """
+        Work out which files to move. Returns a list of
+        (path, source node, target node, size).
+        """
+
+        table = spaceMonitor.table()
+        if len(table) < 2:
+            return []
+
+        nodes = sorted(table, key=lambda node: freeFraction(table[node]))
+        src, dst = nodes[0], nodes[-1]
+        if freeFraction(table[dst]) - freeFraction(table[src]) < \
+                rebalanceThreshold:
+            return []
+
+        # bytes to move so both end up with the same free fraction
+        srcSt, dstSt = table[src], table[dst]
+        srcTotal = srcSt[statvfs.F_BLOCKS] * srcSt[statvfs.F_FRSIZE]
+        dstTotal = dstSt[statvfs.F_BLOCKS] * dstSt[statvfs.F_FRSIZE]
+        srcFree = srcSt[statvfs.F_BAVAIL] * srcSt[statvfs.F_FRSIZE]
+        dstFree = dstSt[statvfs.F_BAVAIL] * dstSt[statvfs.F_FRSIZE]
+        quota = (dstFree * srcTotal - srcFree * dstTotal) / \
+            (srcTotal + dstTotal)
+
+        plan = []
+        for dirPath, dirNames, fileNames in os.walk(src):
+            dirNames[:] = [d for d in dirNames if not isReserved(d)]
+            for name in fileNames:
+                if quota <= 0:
+                    return plan
+                realPath = os.path.join(dirPath, name)
+                path = realPath[len(src):]
+                try:
+                    st = os.lstat(realPath)
+                except OSError:
+                    continue
+                if isReserved(name) or not stat.S_ISREG(st.st_mode) or \
+                        st.st_size > quota or openFiles.isOpen(path) or \
+                        os.path.isdir(src + stripeDir(path)) or \
+                        os.path.lexists(dst + path):
+                    continue
+                plan.append((path, src, dst, st.st_size))
+                quota -= st.st_size
+
+        return plan
+
+    def report(self, plan):
+        """
+        Human readable summary of plan.
+        """
+
+        lines = ['rebalance: %d files, %d bytes%s' % (len(plan),
+            sum([size for _, _, _, size in plan]),
+            rebalanceDryRun and ' (dry run)' or '')]
+        for path, src, dst, size in plan:
+            lines.append('  %s %s -> %s (%d bytes)' % (path,
+                os.path.basename(src), os.path.basename(dst), size))
+        return '\n'.join(lines)
+
+    def run(self, plan):
+        """
+        Carry out plan, within rebalanceBandwidth and rebalanceIOPS.
+        """
+
+        throttle = Throttle(rebalanceBandwidth, rebalanceIOPS)
+        for path, src, dst, _ in plan:
+            try:
+                self.move(path, src, dst, throttle)
+            except (OSError, IOError), why:
+                logging.critical('rebalance %s failed: %s', path, why)
+
+    def move(self, path, src, dst, throttle=None):
+        """
+        Move one file from node src to node dst, giving up if it is opened or
+        changed while being copied. Returns whether it moved.
+        """
+
+        before = os.lstat(src + path)
+        tmpPath = copyToNode(path, src, dst, throttle)
+
+        with openFiles.lock:
+            after = os.lstat(src + path)
+            if openFiles.isOpen(path) or \
+                    (after.st_mtime, after.st_size) != \
+                    (before.st_mtime, before.st_size):
+                logging.debug('rebalance %s: busy, skipped', path)
+                os.unlink(tmpPath)
+                return False
+
+            # both nodes have it for a moment, never neither
+            os.rename(tmpPath, dst + path)
+            locationCache.set(path, dst)
+            os.unlink(src + path)
+
+        namespaceIndex.add(path, dst, after.st_mode, after.st_size)
+        logging.debug('rebalance %s: %s -> %s', path, src, dst)
+        return True
+
+rebalancer = Rebalancer()
+
+class CacheTier(object):
+    """
+    Copies of often read files on a fast node, tierNode, in a reserved dir
+    there. Handles opening each file for reading are counted, once each
+    however much they read, so a file streamed through once doesn't
+    qualify. One opened tierPromote times is copied over in the background,
+    and handles opened after that read the copy. Copies are evicted least
+    recently used, or least often with tierPolicy lfu, to stay within
+    tierSize bytes.
+
+    A copy is only served while it matches the file: writes, truncates,
+    unlinks and renames drop it, and handles reading it go back to the file
+    on their next read.
+    """
+
+    def __init__(self):
+        """
+        Init stopped tier, every method is a no-op until start is called.
+        """
+
+        self.node = None
+        self.root = None
+        self.thread = None
+        # path -> opens, while not cached
+        self.opens = LocationCache(locationCacheSize)
+        # path -> [size, opens, (mtime, size) of the file copied], least
+        # recently used first
+        self.entries = OrderedDict()
+        # paths queued or being copied
+        self.pending = set()
+        self.used = 0
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Empty the cache dir on tierNode and start the copying thread.
+        """
+
+        if tierNode.startswith('/'):
+            self.node = tierNode.rstrip('/')
+        else:
+            self.node = nodeMountPoint + '/' + tierNode
+        root = self.node + '/' + reservedPrefix + 'cache'
+
+        # copies an earlier mount left may be stale
+        shutil.rmtree(root, True)
+        os.makedirs(root)
+        self.root = root
+        logging.critical('cache tier %s, %d bytes', root, tierSize)
+
+        self.thread = threading.Thread(target=self._run, name='unfs-tier')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def opened(self, path, node):
+        """
+        Count a handle reading virtual path, held on node. Queues it for
+        copying once it has been opened often enough.
+        """
+
+        if path in self.entries:
+            with self.lock:
+                entry = self.entries.pop(path, None)
+                if entry is not None:
+                    entry[1] += 1
+                    self.entries[path] = entry
+            return
+
+        opens = (self.opens.get(path) or 0) + 1
+        if opens < tierPromote:
+            self.opens.set(path, opens)
+            return
+        self.opens.invalidate(path)
+        with self.lock:
+            if path in self.pending:
+                return
+            self.pending.add(path)
+        self.queue.put((path, node, opens))
+
+    def open(self, path, version):
+        """
+        Open the copy of virtual path if there is one of version (mtime,
+        size) of the file. Returns (fd, entry), or (None, None).
+        """
+
+        entry = self.entries.get(path)
+        if entry is None or entry[2] != version:
+            metrics.count('cache_lookups', cache='tier', result='miss')
+            return None, None
+        try:
+            fd = os.open(self.root + path, os.O_RDONLY)
+        except OSError, why:
+            logging.debug('cache tier open %s failed: %s', path, why)
+            self.invalidate(path)
+            return None, None
+        metrics.count('cache_lookups', cache='tier', result='hit')
+        return fd, entry
+
+    def isCurrent(self, path, entry):
+        """
+        True if entry, from open, is still the copy of virtual path.
+        """
 
-    mountPoint = base + '/unfs'
-    nodeMountPoint = base + '/fs'
-except IndexError:
-    base = '/'
-    mountPoint = '/unfs'
-    nodeMountPoint = '/fs'
+        return self.entries.get(path) is entry
 
-fuse.fuse_python_api = (0, 2)
-logLevel = logging.CRITICAL
-unfsNodes = []
-unfsNodeLastUpdate = 0
+    def invalidate(self, path, tree=False):
+        """
+        Drop the copy of virtual path, and those below it if tree is set,
+        including one being made.
+        """
 
-logging.basicConfig(level=logLevel, 
-    format='%(asctime)s %(levelname)s %(message)s',
-    filename='/tmp/unfs.log',
-)
+        if not tree and path not in self.entries and path not in self.pending:
+            return
 
-def flag2mode(flags):
-    """
-    Rewrite flags to mode list
-    """
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            paths = [path]
+            if tree:
+                paths += [p for p in self.entries if p.startswith(prefix)]
+                self.pending -= set([p for p in self.pending \
+                    if p.startswith(prefix)])
+            self.pending.discard(path)
+            for cached in paths:
+                self._drop(cached)
 
-    md = {
-        os.O_RDONLY:'r',
-        os.O_WRONLY:'w',
-        os.O_RDWR:'w+'
-    }
-    m = md[flags & (os.O_RDONLY | os.O_WRONLY | os.O_RDWR)]
+    def _drop(self, path):
+        """
+        Remove the copy of virtual path, holding the lock.
+        """
 
-    if flags | os.O_APPEND:
-        m = m.replace('w', 'a', 1)
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return
+        self.used -= entry[0]
+        try:
+            os.unlink(self.root + path)
+        except OSError, why:
+            logging.debug('cache tier unlink %s failed: %s', path, why)
 
-    return m
+    def _makeRoom(self, size):
+        """
+        Evict copies until size more bytes fit, holding the lock.
+        """
 
-def findNewNodes():
-    """
-    Loop through nodeMountPoint to find all nodes mounted.
-    """
+        while self.entries and self.used + size > tierSize:
+            if tierPolicy == 'lfu':
+                victim = min(self.entries, key=lambda p: self.entries[p][1])
+            else:
+                victim = next(iter(self.entries))
+            self._drop(victim)
+            metrics.count('cache_evictions')
 
-    # ignore global warning for clarity
-    # pylint: disable-msg=W0603
-    global unfsNodes, unfsNodeLastUpdate
-    now = time.time()
+    def promote(self, path, node, opens):
+        """
+        Copy virtual path from node into the cache, unless it changes or is
+        dropped meanwhile.
+        """
 
-    if now - unfsNodeLastUpdate > 10:
-        logging.critical('finding nodes in %s' % nodeMountPoint)
-        unfsNodes = []
-        nodes = []
-        for node in os.listdir(nodeMountPoint):
-            nodes.append(nodeMountPoint + '/' + node)
+        before = os.lstat(node + path)
+        version = (before.st_mtime, before.st_size)
+        if not stat.S_ISREG(before.st_mode) or before.st_size > tierSize:
+            with self.lock:
+                self.pending.discard(path)
+            return
 
-        unfsNodes = nodes
-        logging.info(unfsNodes)
-        unfsNodeLastUpdate = now
-    logging.critical(unfsNodes)
+        with self.lock:
+            self._makeRoom(before.st_size)
+        tmpPath = copyToNode(path, node, self.root)
 
-def unfsRandom():
-    """
-    Picks the best (not random) node to write to.
-    """
+        with self.lock:
+            try:
+                after = os.lstat(node + path)
+            except OSError:
+                after = None
+            if path not in self.pending or after is None or \
+                    (after.st_mtime, after.st_size) != version:
+                self.pending.discard(path)
+                os.unlink(tmpPath)
+                return
+            self.pending.discard(path)
+            self._makeRoom(before.st_size)
+            os.rename(tmpPath, self.root + path)
+            self.entries[path] = [before.st_size, opens, version]
+            self.used += before.st_size
 
-    best = 0
-    bestNode = None
-    nodeSizes = {}
+        metrics.count('cache_promotions')
+        logging.debug('cache tier %s: %d bytes', path, before.st_size)
 
-    for node in unfsNodes:
-        st = os.statvfs(node)
-        freeSpace = st[statvfs.F_BAVAIL]*st[statvfs.F_BSIZE]
-        nodeSizes[freeSpace] = 1
-        if freeSpace > best:
-            bestNode = node
-            best = freeSpace
+    def _run(self):
+        """
+        Copy queued files forever.
+        """
 
-    # if all are equal, force a random choice
-    if bestNode and len(nodeSizes.keys()) > 1:
-        node = bestNode
-        logging.debug('best node: %s' % node)
-    else:
-        node = unfsNodes[random.randrange(len(unfsNodes))]
-        logging.debug('random node: %s' % node)
+        while True:
+            path, node, opens = self.queue.get()
+            try:
+                self.promote(path, node, opens)
+            except (OSError, IOError), why:
+                logging.critical('cache tier %s failed: %s', path, why)
+                with self.lock:
+                    self.pending.discard(path)
 
-    # FIXME: locking
-    return node
+cacheTier = CacheTier()
 
 class UNFS(Fuse):
     """
@@ -114,75 +2949,112 @@ class UNFS(Fuse):
         self.file_class = None
         Fuse.__init__(self, *args, **kw)
 
+    def fsinit(self):
+        """
+        Called once mounted and daemonized, start background threads.
+        """
+
+        nodeWatcher.start()
+        breaker.start()
+        tracer.start()
+        spaceMonitor.start()
+        if indexPath:
+            namespaceIndex.open(indexPath, indexCrawlInterval)
+        if rebalanceInterval:
+            rebalancer.start()
+        if repairInterval:
+            repairer.start()
+        if tierNode:
+            cacheTier.start()
+
+    @measured
     def getattr(self, path):
         """
         os.lstat wrapper. lstat because we don't want to make symlinks
         appear to be actual files.
         """
 
-        logging.debug('getattr %s' % path)
-        for node in unfsNodes:
-            newPath = node + path
-            logging.debug('_getattr %s' % newPath)
-            try:
-                logging.debug(os.lstat(newPath))
-                return os.lstat(newPath)
-            except OSError, why:
-                logging.debug('getattr %s failed: %s' % (newPath, why))
+        if inStatsDir(path):
+            return statsAttr(path) or -errno.ENOENT
+        if writeBack.handles:
+            writeBack.flushPath(path)
 
-        return -errno.ENOENT
+        node, st = findNode(path)
+        if node is None:
+            return -errno.ENOENT
 
+        return st
+
+    @measured
     def readlink(self, path):
         """
         os.readlink wrapper
         """
 
-        logging.debug('readlink %s' % path)
+        node, target = findNode(path, os.readlink)
+        if node is None:
+            return -errno.ENOENT
 
-        for node in unfsNodes:
-            newPath = node + path
-            try:
-                return os.readlink(newPath)
-            except OSError, why:
-                logging.debug('readlink %s failed: %s' % (newPath, why))
+        return target
 
+    @measured
     def readdir(self, path, offset):
         """
         Return files in dir, add in '.' and '..'.
         """
 
         # FIXME: should probably use generated '.' and '..' based on aggregates
-        logging.debug('readdir %s %s' % (path, offset))
-        contents = {}
-        for node in unfsNodes:
-            newPath = node + path
-            try:
-                for dirFile in os.listdir(newPath):
-                    if dirFile != '':
-                        contents[dirFile] = fuse.Direntry(dirFile)
-            except OSError, why:
-                logging.debug('readdir %s failed: %s' % (newPath, why))
 
-        contents['.'] = fuse.Direntry('.')
-        contents['..'] = fuse.Direntry('..')
+        # entry n carries offset n + 1, the kernel comes back with the offset
+        # of the last entry it took when its buffer fills up. Every entry
+        # leaves a cursor behind so that resuming doesn't relist from scratch.
+        cursor = readdirCursors.pop((path, offset))
+        if cursor is None and path == statsDir:
+            names = iter(['.', '..'] + sorted(statsFiles))
+            for _ in itertools.islice(names, offset):
+                pass
+        elif cursor is None:
+            metrics.count('cache_lookups', cache='readdir', result='miss')
+            names = itertools.chain(['.', '..'], listDir(path))
+            for _ in itertools.islice(names, offset):
+                pass
+        else:
+            metrics.count('cache_lookups', cache='readdir', result='hit')
+            name, rest = cursor
+            names = itertools.chain([name], rest)
 
-        for dirFile, entry in contents.iteritems():
-            yield entry
+        last = None
+        for last, name in enumerate(names, offset):
+            readdirCursors.pop((path, last - 1))
+            readdirCursors.set((path, last), (name, names))
+            yield fuse.Direntry(name, offset=last + 1)
 
+        readdirCursors.pop((path, last))
+
+    @measured
     def unlink(self, path):
         """
         Unlink file.
         """
 
-        logging.debug('unlink %s' % path)
-        for node in unfsNodes:
-            newPath = node + path
-            try:
-                os.unlink(newPath)
-                logging.critical('del file: %s' % newPath)
-            except OSError, why:
-                logging.debug('unlink %s failed: %s' % (newPath, why))
+        def unlinkNode(node):
+            """
+            Unlink path and any stripe chunks on one node.
+            """
+
+            removeStripe(node, path)
+            os.unlink(node + path)
 
+        for node, _, why in fanOut(unlinkNode):
+            if why:
+                logging.debug('unlink %s%s failed: %s', node, path, why)
+            else:
+                logging.debug('del file: %s%s', node, path)
+        locationCache.invalidate(path)
+        namespaceIndex.remove(path)
+        cacheTier.invalidate(path)
+
+    @measured
     def rmdir(self, path):
         """
         rmdir. Removes dir on all nodes.
@@ -190,102 +3062,218 @@ class UNFS(Fuse):
 
         # FIXME: this will succeed on some nodes that don't have files yet...
         
-        logging.debug('rmdir %s' % path)
-        for node in unfsNodes:
-            newPath = node + path
-            try:
-                os.rmdir(newPath)
-            except OSError, why:
-                logging.debug('rmdir %s failed: %s' % (newPath, why))
+        for node, _, why in fanOut(lambda node: os.rmdir(node + path)):
+            if why:
+                logging.debug('rmdir %s%s failed: %s', node, path, why)
+        locationCache.invalidate(path, tree=True)
+        namespaceIndex.remove(path, tree=True)
+        cacheTier.invalidate(path, tree=True)
 
+    @measured
     def symlink(self, path, path1):
         """
         Symlink.
         """
 
-        newPath = unfsRandom() + path1
-        logging.debug('symlink %s %s' % (path, newPath))
-        os.symlink(path, newPath)
+        if inStatsDir(path1):
+            return -errno.EPERM
+
+        node = unfsRandom(path1)
+        newPath = node + path1
+        logging.debug('symlink %s %s', path, newPath)
+        nodeStats.timed(node, os.symlink, path, newPath)
+        pathCreated(path1, node)
+        namespaceIndex.add(path1, node, stat.S_IFLNK)
 
+    @measured
     def rename(self, path, path1):
         """
         Rename file, basically mv.
-        Have to be careful to only rename files on the same filesystem.
+        Renames on every node holding path, so nothing changes filesystem and
+        a mv is always a metadata operation. Parent dirs of path1 are made on
+        those nodes as needed. path1 is checked on every node first, as one
+        where it can't be replaced would fail after the others moved.
         """
 
-        logging.debug('mv %s %s' % (path, path1))
-        newPath = unfsRandom() + path1
-        for node in unfsNodes:
-            # FIXME: moved files will end up on other nodes, which is slow.
-            oldPath = node + path
+        def target(node):
+            """
+            Whether path1 is a dir on node, and whether it has names there.
+            """
+
+            isDir1 = stat.S_ISDIR(os.lstat(node + path1).st_mode)
+            return isDir1, isDir1 and bool([name for name in \
+                iterDir(node + path1) if not isReserved(name)])
+
+        def renameNode(node):
+            """
+            mv on one node, if path is there. Returns whether it is a dir, or
+            None if the node only had stripe chunks.
+            """
+
+            chunks = os.path.isdir(node + stripeDir(path))
+            if chunks:
+                removeStripe(node, path1)
+                makeParents(node, stripeDir(path1))
+                os.rename(node + stripeDir(path), node + stripeDir(path1))
+
             try:
-                logging.debug('mv %s %s' % (oldPath, newPath))
-                os.rename(oldPath, newPath)
-            except OSError, why:
-                logging.debug('mv %s %s failed: %s' % (oldPath, newPath, why))
+                isDir = stat.S_ISDIR(os.lstat(node + path).st_mode)
+            except OSError:
+                if chunks:
+                    return None
+                raise
+            makeParents(node, path1)
+            os.rename(node + path, node + path1)
+            return isDir
+
+        if inStatsDir(path) or inStatsDir(path1):
+            return -errno.EPERM
+
+        _, st = findNode(path)
+        if st is None:
+            return -errno.ENOENT
+        if path == path1:
+            return
+        for node, found, why in fanOut(target):
+            if why:
+                if getattr(why, 'errno', errno.ENOENT) != errno.ENOENT:
+                    return -why.errno
+            elif found[0] and not stat.S_ISDIR(st.st_mode):
+                return -errno.EISDIR
+            elif not found[0] and stat.S_ISDIR(st.st_mode):
+                return -errno.ENOTDIR
+            elif found[1]:
+                return -errno.ENOTEMPTY
+
+        moved = []
+        touched = []
+        isDir = False
+        err = None
+        for node, nodeIsDir, why in fanOut(renameNode):
+            if why:
+                logging.debug('mv %s%s %s failed: %s', node, path, path1, why)
+                if getattr(why, 'errno', errno.ENOENT) != errno.ENOENT:
+                    err = err or why.errno
+            elif nodeIsDir is None:
+                touched.append(node)
+            else:
+                moved.append(node)
+                isDir |= nodeIsDir
+
+        if not moved:
+            return -(err or errno.ENOENT)
+
+        def unlinkReplaced(node):
+            """
+            Remove a replaced file from a node the rename didn't touch.
+            """
+
+            removeStripe(node, path1)
+            os.unlink(node + path1)
+
+        # a replaced file on another node would shadow the moved one
+        if not isDir:
+            for node, _, why in fanOut(unlinkReplaced, [node for node in \
+                    unfsNodes if node not in moved and node not in touched]):
+                if why and why.errno != errno.ENOENT:
+                    logging.debug('mv %s replacing %s%s failed: %s',
+                        path, node, path1, why)
+
+        openFiles.renamed(path, path1)
+        locationCache.invalidate(path, tree=True)
+        pathCreated(path1, not isDir and moved[0] or None, tree=True)
+        namespaceIndex.rename(path, path1)
+        fileVersions.pop(path)
+        fileVersions.pop(path1)
+        cacheTier.invalidate(path, tree=True)
+        cacheTier.invalidate(path1, tree=True)
+        # moved on some nodes only, the caches above hold for those
+        if err:
+            return -err
 
+    @measured
     def link(self, path, path1):
         """
         hard link.
         """
 
-        newPath = unfsRandom() + path1
-        logging.debug('hard link %s -> %s (%s)' % (path, path1, newPath))
-        os.link(path, newPath)
+        if inStatsDir(path) or inStatsDir(path1):
+            return -errno.EPERM
 
+        node = unfsRandom(path1)
+        newPath = node + path1
+        logging.debug('hard link %s -> %s (%s)', path, path1, newPath)
+        nodeStats.timed(node, os.link, path, newPath)
+        pathCreated(path1, node)
+        namespaceIndex.add(path1, node, stat.S_IFREG)
+
+    @measured
     def chmod(self, path, mode):
         """
         chmod.
         """
 
-        logging.debug('chmod %s %s' % (path, mode))
-        for node in unfsNodes:
-            newPath = node + path
-            try:
-                os.chmod(newPath, mode)
-            except OSError, why:
-                logging.debug('chmod %s %s failed: %s' % (path, mode, why))
+        for node, _, why in fanOut(lambda node: os.chmod(node + path, mode)):
+            if why:
+                logging.debug('chmod %s %s failed: %s', path, mode, why)
 
+    @measured
     def chown(self, path, user, group):
         """
         Change ownership of file.
         """
 
-        logging.debug('chown %s %s:%s' % (path, user, group))
-        for node in unfsNodes:
-            newPath = node + path
-            try:
-                os.chown(newPath, user, group)
-            except OSError, why:
-                logging.debug('chown %s %s:%s failed: %s' % \
-                    (path, user, group, why))
+        for node, _, why in fanOut(
+                lambda node: os.chown(node + path, user, group)):
+            if why:
+                logging.debug('chown %s %s:%s failed: %s',
+                    path, user, group, why)
 
+    @measured
     def truncate(self, path, length):
         """
         Truncate file. Don't know why this isn't covered by UnfsFile.truncate.
         """
 
-        logging.debug('truncate %s to %s'  % (path, length))
-        for node in unfsNodes:
+        def truncateNode(node):
+            """
+            Truncate path on one node, if it is there.
+            """
+
             newPath = node + path
-            try:
-                os.stat(newPath)
-                f = open(newPath, "a")
-                f.truncate(length)
-                f.close()
-            except OSError, why:
-                logging.debug('truncate %s to %s failed: %s' % \
-                    (path, length, why))
+            trimStripe(node, path, length)
+            os.stat(newPath)
+            f = open(newPath, "a")
+            f.truncate(length)
+            f.close()
+
+        # buffered writes landing after the truncate would undo it
+        writeBack.flushPath(path)
+        cacheTier.invalidate(path)
 
+        for node, _, why in fanOut(truncateNode):
+            if why:
+                logging.debug('truncate %s to %s failed: %s',
+                    path, length, why)
+            else:
+                namespaceIndex.add(path, node, stat.S_IFREG, length)
+
+    @measured
     def mknod(self, path, mode, dev):
         """
         Make node thingy.
         """
 
-        logging.debug('mknod %s %s %s' % (path, mode, dev))
-        newPath = unfsRandom() + path
-        os.mknod(newPath, mode, dev)
+        if inStatsDir(path):
+            return -errno.EPERM
+
+        node = unfsRandom(path)
+        newPath = node + path
+        nodeStats.timed(node, os.mknod, newPath, mode, dev)
+        pathCreated(path, node)
+        namespaceIndex.add(path, node, mode)
 
+    @measured
     def mkdir(self, path, mode):
         """
         Make a directory.
@@ -293,44 +3281,48 @@ class UNFS(Fuse):
         nodes.
         """
 
-        logging.debug('mkdir %s (%s)' % (path, mode))
-        for node in unfsNodes:
-            newPath = node + path
-            try:
-                logging.debug('mkdir %s' % newPath)
-                os.mkdir(newPath, mode)
-            except OSError, why:
-                logging.debug('mkdir %s failed: %s' % (newPath, why))
+        if inStatsDir(path):
+            return -errno.EEXIST if path == statsDir else -errno.EPERM
 
+        made = []
+        for node, _, why in fanOut(lambda node: os.mkdir(node + path, mode)):
+            if why:
+                logging.debug('mkdir %s%s failed: %s', node, path, why)
+            else:
+                made.append(node)
+        # dir is on every node now, so the first node may have changed
+        pathCreated(path)
+        if made:
+            namespaceIndex.add(path, made[0], stat.S_IFDIR)
+
+    @measured
     def utime(self, path, times):
         """
         Set access and modified time on file.
         If times is None, set to current time.
         """
 
-        logging.debug('utime on %s to %s' % (path, times))
-        for node in unfsNodes:
-            newPath = node + path
-            try:
-                os.utime(newPath, times)
-            except (OSError, TypeError), why:
-                logging.debug('utime on %s to %s failed: %s' % \
-                    (path, times, why))
+        for node, _, why in fanOut(lambda node: os.utime(node + path, times)):
+            if why:
+                logging.debug('utime on %s to %s failed: %s',
+                    path, times, why)
 
+    @measured
     def access(self, path, mode):
         """
         Check for access on a file with specific mode.
         """
 
-        logging.debug('access: %s %s' % (path, mode))
-        yes = 0
-        for node in unfsNodes:
-            newPath = node + path
-            yes |= os.access(newPath, mode)
+        if inStatsDir(path):
+            if statsAttr(path) is None:
+                return -errno.ENOENT
+            return mode & os.W_OK and -errno.EACCES or 0
 
-        if not yes:
+        node, _ = findNode(path, lambda newPath: checkAccess(newPath, mode))
+        if node is None:
             return -errno.EACCES
 
+    @measured
     def statfs(self):
         """
         Returns info for use by 'df' etc.
@@ -338,7 +3330,6 @@ class UNFS(Fuse):
         calls, making sure to convert them into equal sized blocks.
         """
 
-        logging.debug('statfs')
         my_bsize = 4096
 
         st = fuse.StatVfs()
@@ -350,9 +3341,7 @@ class UNFS(Fuse):
         st.f_files = 0
         st.f_ffree = 0
 
-        for node in unfsNodes:
-            nst = os.statvfs(node)
-            div = nst[statvfs.F_FRSIZE]/my_bsize
+        for nst in spaceMonitor.table().itervalues():
             st.f_blocks += nst[statvfs.F_BLOCKS] \
                 * nst[statvfs.F_FRSIZE] / my_bsize
             st.f_bfree  += nst[statvfs.F_BFREE] \
@@ -378,99 +3367,683 @@ class UNFS(Fuse):
             Opens resulting file.
             """
 
+            # adjacent writes waiting to go out as one, see write
+            self.bufferOffset = 0
+            self.bufferData = []
+            self.bufferLength = 0
+            self.bufferSince = 0
+            self.bufferLock = threading.Lock()
+            self.writeError = None
+
+            # space placement still counts as taken per node, see
+            # SpaceReservations, and the lock a move off a full node takes
+            self.reservations = {}
+            self.reservationLock = threading.Lock()
+            self.moveLock = threading.Lock()
+
+            # copy on the cache tier this handle reads, see CacheTier
+            self.tierFd = None
+            self.tierEntry = None
+
+            # registered before the lookup, see OpenFiles
+            self.virtualPath = path
+            openFiles.opened(self)
+            traced = tracer.rate and tracer.begin('open', path)
+            start = time.time()
+            err = None
+            # pylint: disable-msg=W0702
+            try:
+                self._open(path, flags, *mode)
+            except:
+                openFiles.closed(self)
+                self._releaseReservations()
+                err = getattr(os.sys.exc_info()[1], 'errno', None) or errno.EIO
+                raise
+            finally:
+                metrics.observe('open', time.time() - start, err)
+                if traced:
+                    tracer.end('open', path, time.time() - start, err)
+            # pylint: enable-msg=W0702
+
+        def _open(self, path, flags, *mode):
+            """
+            Find or create path and open it, see __init__.
+            """
+
+            if inStatsDir(path):
+                self._openStats(path, flags)
+                return
+
             newPath = None
 
             # try to find existing file first
-            for node in unfsNodes:
-                try:
-                    os.stat(node + path)
-                    newPath = node + path
-                    logging.critical('found file: %s' % newPath)
-                    break
-                except OSError:
-                    logging.debug('%s does not exist' % newPath)
+            node, _ = findNode(path, os.stat)
+            if node is not None:
+                newPath = node + path
+                logging.debug('found file: %s', newPath)
+            else:
+                logging.debug('%s does not exist', path)
+                if not flags & os.O_CREAT:
+                    raise OSError(errno.ENOENT, os.strerror(errno.ENOENT),
+                        path)
 
             m = flag2mode(flags)
 
             # if no file exists, choose random to write
+            created = False
             if 'w' in m or 'a' in m:
-                # find new nodes here
-                findNewNodes()
                 if not newPath:
-                    newPath = unfsRandom() + path
-                    logging.critical('new file: %s' % newPath)
+                    node = placeNodes(path=path, reserve=writeReservation)[0]
+                    self.reservations[node] = writeReservation
+                    newPath = node + path
+                    created = True
+                    logging.debug('new file: %s', newPath)
 
             self.path = newPath
-            self.file = os.fdopen(os.open(self.path, flags, *mode), m)
-            self.fd = self.file.fileno()
+            self.node = node
+            self.virtualPath = path
+            self.writable = bool(flags & (os.O_WRONLY | os.O_RDWR))
+            self.flags = flags
+            self.fd = nodeStats.timed(node, os.open, self.path, flags, *mode)
+            if flags & os.O_CREAT:
+                pathCreated(path, node)
+
+            # striped files keep their data in chunks, see Stripe
+            self.stripe = None
+            self.chunkFds = {}
+            self.chunkLock = threading.Lock()
+            if created and isStriped(path):
+                self.stripe = Stripe.create(path,
+                    [node] + [other for other in unfsNodes if other != node])
+            elif not created:
+                try:
+                    self.stripe = Stripe.load(node, path)
+                except IOError:
+                    pass
+                if self.stripe and flags & os.O_TRUNC:
+                    self._trimChunks(0)
+
+            # replicated files have a copy on several nodes, writes go to all
+            # of them and reads to the least busy
+            self.replicaFds = {}
+            self.replicaLock = threading.Lock()
+            self.deadFds = []
+            if not self.stripe and replicaCount(path) > 1:
+                self._openReplicas(path, flags, created, *mode)
+
+            # kernel can keep its page cache if nothing changed since the
+            # last handle saw this file
+            st = os.fstat(self.fd)
+            version = (st.st_mtime, st.st_size)
+            self.keep_cache = fileVersions.get(path) == version
+            fileVersions.set(path, version)
+            metrics.count('cache_lookups', cache='page',
+                result=self.keep_cache and 'hit' or 'miss')
+
+            if cacheTier.root and self.writable:
+                cacheTier.invalidate(path)
+            elif cacheTier.root and not self.stripe:
+                self.tierFd, self.tierEntry = cacheTier.open(path, version)
+                cacheTier.opened(path, node)
+
+            # access pattern tracking, see _readHints
+            self.nextOffset = 0
+            self.sequentialReads = 0
+            self.readaheadTo = 0
+            self.droppedTo = 0
+            self.hintLock = threading.Lock()
+
+        def _openStats(self, path, flags):
+            """
+            Open a stats file read only, on a snapshot of its contents in an
+            unlinked temporary file so the normal read path serves it.
+            """
+
+            content = statsContent(path)
+            if content is None:
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                raise OSError(errno.EACCES, os.strerror(errno.EACCES), path)
+
+            tmp = tempfile.TemporaryFile()
+            tmp.write(content)
+            tmp.flush()
+            self.fd = os.dup(tmp.fileno())
+            tmp.close()
+
+            self.path = None
+            self.node = None
+            self.virtualPath = path
+            self.writable = False
+            self.stripe = None
+            self.chunkFds = {}
+            self.replicaFds = {}
+            self.replicaLock = threading.Lock()
+            self.deadFds = []
+            # contents are made at open, the size getattr gave may be stale
+            self.direct_io = True
+            self.keep_cache = False
+            self.nextOffset = 0
+            self.sequentialReads = 0
+            self.readaheadTo = 0
+            self.droppedTo = 0
+            self.hintLock = threading.Lock()
+
+        def _openReplicas(self, path, flags, created, *mode):
+            """
+            Open every copy of path, placing new ones for a new file. Copies
+            that can't be opened are left for the repairer.
+            """
+
+            if created:
+                nodes = placeNodes(replicaCount(path) - 1,
+                    exclude=[self.node], path=path, reserve=writeReservation)
+                for node in nodes:
+                    self.reservations[node] = writeReservation
+            else:
+                nodes = [node for node in findReplicas(path) \
+                    if node != self.node]
+
+            def openReplica(node):
+                """
+                Open the copy on one node.
+                """
+
+                if created:
+                    makeParents(node, path)
+                return os.open(node + path, flags, *mode)
+
+            self.replicaFds[self.node] = self.fd
+            for node, fd, why in fanOut(openReplica, nodes):
+                if why:
+                    logging.critical('replica %s%s failed: %s',
+                        node, path, why)
+                    if node in self.reservations:
+                        spaceReservations.release(node,
+                            self.reservations.pop(node))
+                else:
+                    self.replicaFds[node] = fd
+
+        def _allReplicas(self, func):
+            """
+            Call func(fd) for every copy in parallel. Copies that fail are
+            dropped from the handle and removed in the background, for the
+            repairer to replace; only if all fail is the error raised.
+            """
+
+            with self.replicaLock:
+                fds = dict(self.replicaFds)
+            results = fanOut(lambda node: func(fds[node]), fds.keys())
+            good = [node for node, _, why in results if not why]
+            if not good:
+                raise results[0][2]
+
+            for node, _, why in results:
+                with self.replicaLock:
+                    if not why or node not in self.replicaFds:
+                        continue
+                    logging.critical('replica %s%s dropped: %s',
+                        node, self.virtualPath, why)
+                    self.deadFds.append(self.replicaFds.pop(node))
+                    if node == self.node:
+                        self.node = good[0]
+                        self.fd = self.replicaFds[self.node]
+                        self.path = self.node + self.virtualPath
+                nodePool.submit(lambda node: os.unlink(node + \
+                    self.virtualPath), node)
 
+        @measured
         def read(self, length, offset):
             """
-            Read from self.file
+            Read from self.fd at offset, safe to call from several threads.
             """
 
-            self.file.seek(offset)
-            return self.file.read(length)
+            # this or another handle may have buffered writes to the file
+            if writeBack.handles:
+                writeBack.flushPath(self.virtualPath)
+            if self.stripe:
+                return self._stripedRead(length, offset)
 
+            fd = self.fd
+            node = self.node
+            # stats files have no node, see _openStats
+            if node is None:
+                return pread(fd, length, offset)
+
+            # the copy stays open until release, but once dropped the file is
+            # read instead
+            if self.tierFd is not None and \
+                    cacheTier.isCurrent(self.virtualPath, self.tierEntry):
+                data = pread(self.tierFd, length, offset)
+                metrics.add('bytes_read', len(data), node=cacheTier.node)
+                return data
+
+            if self.replicaFds:
+                node = nodeStats.pick(self.replicaFds.keys())
+                try:
+                    # a copy dropped meanwhile falls back to the primary
+                    fd = self.replicaFds.get(node, self.fd)
+                    data = nodeStats.timed(node, pread, fd, length, offset)
+                finally:
+                    nodeStats.done(node)
+            else:
+                data = nodeStats.timed(node, pread, fd, length, offset)
+            metrics.add('bytes_read', len(data), node=node)
+            # concurrent reads of one handle take turns updating the hints
+            with self.hintLock:
+                self._readHints(fd, offset, len(data))
+            return data
+
+        def _readHints(self, fd, offset, length):
+            """
+            Spot sequential streams and hint the backing file: prefetch a
+            window ahead of the reader and drop what it has already read, since
+            the kernel caches those pages on the unfs side anyway.
+            """
+
+            if offset != self.nextOffset:
+                if self.sequentialReads >= sequentialThreshold:
+                    fadvise(fd, 0, 0, POSIX_FADV_NORMAL)
+                self.sequentialReads = 0
+                self.readaheadTo = self.droppedTo = offset
+            else:
+                self.sequentialReads += 1
+
+            end = offset + length
+            self.nextOffset = end
+            if self.sequentialReads < sequentialThreshold:
+                return
+            if self.sequentialReads == sequentialThreshold:
+                fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+            # top the window up once the reader is half way through it
+            if end + readaheadWindow / 2 > self.readaheadTo:
+                start = max(end, self.readaheadTo)
+                self.readaheadTo = end + readaheadWindow
+                fadvise(fd, start, self.readaheadTo - start,
+                    POSIX_FADV_WILLNEED)
+
+            if dropBehind and offset - self.droppedTo > readaheadWindow:
+                fadvise(fd, self.droppedTo, offset - self.droppedTo,
+                    POSIX_FADV_DONTNEED)
+                self.droppedTo = offset
+
+        @measured
         def write(self, buf, offset):
             """
-            Write buf to self.file.
+            Write buf at offset, safe to call from several threads. A write
+            carrying on where the last one ended joins it in a buffer that
+            goes to the node as one write once it holds writeBufferSize bytes
+            or is writeBufferAge old, or on flush, fsync or release; an error
+            doing so is raised by the next of those.
+            """
+
+            with self.bufferLock:
+                self._raiseWriteError()
+                if not self.bufferData or \
+                        offset != self.bufferOffset + self.bufferLength:
+                    self._pushBuffer()
+                    if len(buf) >= writeBufferSize:
+                        return self._writeThrough(buf, offset)
+                    self.bufferOffset = offset
+                    self.bufferSince = time.time()
+                    writeBack.dirty(self)
+                self.bufferData.append(buf)
+                self.bufferLength += len(buf)
+                if self.bufferLength >= writeBufferSize:
+                    self._pushBuffer()
+            return len(buf)
+
+        def _raiseWriteError(self):
+            """
+            Raise, once, the error a background push of the buffer ran into.
             """
 
-            self.file.seek(offset)
-            self.file.write(buf)
+            why, self.writeError = self.writeError, None
+            if why:
+                raise why
+
+        def _pushBuffer(self):
+            """
+            Write out the buffer, with bufferLock held.
+            """
+
+            if not self.bufferData:
+                return
+            data = ''.join(self.bufferData)
+            offset = self.bufferOffset
+            self.bufferData = []
+            self.bufferLength = 0
+            writeBack.clean(self)
+            self._writeThrough(data, offset)
+
+        def flushBuffer(self, raiseError=False):
+            """
+            Write out the buffer. Errors are kept for the next write, flush,
+            fsync or release unless raiseError is set.
+            """
+
+            with self.bufferLock:
+                try:
+                    self._pushBuffer()
+                except (OSError, IOError), why:
+                    if raiseError:
+                        raise
+                    logging.critical('write back of %s failed: %s',
+                        self.virtualPath, why)
+                    self.writeError = why
+                if raiseError:
+                    self._raiseWriteError()
+
+        def _writeThrough(self, buf, offset):
+            """
+            Write buf to the node(s) at offset.
+            """
+
+            if cacheTier.root:
+                cacheTier.invalidate(self.virtualPath)
+            if self.stripe:
+                return self._stripedWrite(buf, offset)
+            if self.replicaFds:
+                self._allReplicas(lambda fd: pwrite(fd, buf, offset))
+                for node in self.replicaFds:
+                    metrics.add('bytes_written', len(buf), node=node)
+                self._useReservations(len(buf))
+                return len(buf)
+
+            # a full node moves the file elsewhere and the write goes again
+            tried = []
+            while True:
+                fd = self.fd
+                try:
+                    written = nodeStats.timed(self.node, pwrite, fd, buf,
+                        offset)
+                    break
+                except OSError, why:
+                    if why.errno != errno.ENOSPC:
+                        raise
+                    tried.append(self.node)
+                    if not self._spill(fd, tried):
+                        raise
+            metrics.add('bytes_written', written, node=self.node)
+            self._useReservations(written)
+            return written
+
+        def _useReservations(self, length):
+            """
+            length bytes were written, they now show on the nodes and no
+            longer need reserving.
+            """
+
+            if not self.reservations:
+                return
+            with self.reservationLock:
+                for node, left in self.reservations.items():
+                    used = min(left, length)
+                    spaceReservations.release(node, used)
+                    if used < left:
+                        self.reservations[node] = left - used
+                    else:
+                        del self.reservations[node]
+
+        def _releaseReservations(self):
+            """
+            Give back whatever this handle still has reserved.
+            """
+
+            with self.reservationLock:
+                for node, left in self.reservations.items():
+                    spaceReservations.release(node, left)
+                self.reservations.clear()
+
+        def _spill(self, fd, tried):
+            """
+            Move the file off its node after a write on fd ran out of space,
+            tried being the nodes found full. Only done while this is the one
+            handle on the file, other handles would carry on writing the old
+            copy. Returns whether the write should go again, the file having
+            moved, maybe by another thread.
+            """
+
+            with self.moveLock:
+                if self.fd != fd:
+                    return True
+                path = self.virtualPath
+                if openFiles.count(path) > 1:
+                    return False
+
+                while True:
+                    nodes = placeNodes(exclude=tried, path=path,
+                        reserve=writeReservation)
+                    if not nodes:
+                        return False
+                    dst = nodes[0]
+                    try:
+                        tmpPath = copyToNode(path, self.node, dst)
+                    except (OSError, IOError), why:
+                        spaceReservations.release(dst, writeReservation)
+                        if why.errno != errno.ENOSPC:
+                            raise
+                        tried.append(dst)
+                        continue
+                    if self._moveTo(dst, tmpPath, path):
+                        return True
+                    spaceReservations.release(dst, writeReservation)
+                    return False
+
+        def _moveTo(self, dst, tmpPath, path):
+            """
+            Swap the copy at tmpPath on node dst in for the file at virtual
+            path, as Rebalancer.move does, unless it got opened or renamed
+            meanwhile. Returns whether it moved.
+            """
+
+            src = self.node
+            flags = self.flags & ~(os.O_CREAT | os.O_EXCL | os.O_TRUNC)
+            with openFiles.lock:
+                # a rename since the copy was made leaves it behind
+                if openFiles.count(path) > 1 or self.virtualPath != path:
+                    os.unlink(tmpPath)
+                    return False
+                os.rename(tmpPath, dst + path)
+                newFd = os.open(dst + path, flags)
+                # reads racing the move still hold the old fd, see release
+                self.deadFds.append(self.fd)
+                self.fd, self.node, self.path = newFd, dst, dst + path
+                locationCache.set(path, dst)
+                os.unlink(src + path)
+
+            with self.reservationLock:
+                if src in self.reservations:
+                    spaceReservations.release(src, self.reservations.pop(src))
+                self.reservations[dst] = \
+                    self.reservations.get(dst, 0) + writeReservation
+            metrics.count('spills', src=src, dst=dst)
+            logging.critical('%s full, moved %s to %s', src, path, dst)
+            return True
+
+        def _chunkFd(self, i, create):
+            """
+            fd for chunk i of a striped file, opened on first use. Returns None
+            for a chunk that was never written unless create is set.
+            """
+
+            with self.chunkLock:
+                fd = self.chunkFds.get(i)
+            if fd is not None:
+                return fd
+
+            chunkPath = self.stripe.chunkPath(i)
+            flags = self.writable and os.O_RDWR or os.O_RDONLY
+            try:
+                fd = os.open(chunkPath, flags)
+            except OSError, why:
+                if why.errno != errno.ENOENT or not create:
+                    if why.errno == errno.ENOENT:
+                        return None
+                    raise
+                chunkNode = self.stripe.chunkNode(i)
+                if not os.path.exists(chunkNode + stripeDir(self.virtualPath) \
+                        + '/layout'):
+                    self.stripe.writeLayout(chunkNode)
+                fd = os.open(chunkPath, flags | os.O_CREAT,
+                    stat.S_IMODE(os.fstat(self.fd).st_mode))
+
+            with self.chunkLock:
+                if i in self.chunkFds:
+                    os.close(fd)
+                    return self.chunkFds[i]
+                self.chunkFds[i] = fd
+            return fd
+
+        def _stripedRead(self, length, offset):
+            """
+            Read a striped file, every node's chunks in parallel. Chunks that
+            were never written read as zeros.
+            """
+
+            length = max(0, min(length, os.fstat(self.fd).st_size - offset))
+            buf = bytearray(length)
+            pieces = self.stripe.byNode(self.stripe.pieces(offset, length))
+
+            def readNode(node):
+                """
+                Read this node's pieces into buf.
+                """
+
+                for i, chunkOffset, pieceLength, at in pieces[node]:
+                    fd = self._chunkFd(i, False)
+                    if fd is not None:
+                        data = pread(fd, pieceLength, chunkOffset)
+                        buf[at:at + len(data)] = data
+                        metrics.add('bytes_read', len(data), node=node)
+
+            for _, _, why in fanOut(readNode, pieces.keys()):
+                if why:
+                    raise why
+            return str(buf)
+
+        def _stripedWrite(self, buf, offset):
+            """
+            Write a striped file, every node's chunks in parallel, then grow
+            the manifest to the new logical size.
+            """
+
+            pieces = self.stripe.byNode(self.stripe.pieces(offset, len(buf)))
+
+            def writeNode(node):
+                """
+                Write this node's pieces of buf.
+                """
+
+                for i, chunkOffset, pieceLength, at in pieces[node]:
+                    pwrite(self._chunkFd(i, True), buf[at:at + pieceLength],
+                        chunkOffset)
+                    metrics.add('bytes_written', pieceLength, node=node)
+
+            for _, _, why in fanOut(writeNode, pieces.keys()):
+                if why:
+                    raise why
+
+            end = offset + len(buf)
+            with self.chunkLock:
+                if end > os.fstat(self.fd).st_size:
+                    os.ftruncate(self.fd, end)
             return len(buf)
 
+        def _trimChunks(self, length):
+            """
+            Cut the chunks of a striped file down to length bytes on every
+            node of its layout.
+            """
+
+            nodes = [nodeMountPoint + '/' + name for name in self.stripe.nodes]
+            for node, _, why in fanOut(
+                    lambda node: trimStripe(node, self.virtualPath, length),
+                    nodes):
+                if why:
+                    raise why
+
+        @measured
         def release(self, flags):
             """
             Close file.
             """
 
-            logging.debug('release on %s with flags:%s' % (self.fd, flags))
-            self.file.close()
+            self.flushBuffer()
+            if self.writable:
+                st = os.fstat(self.fd)
+                namespaceIndex.add(self.virtualPath, self.node, st.st_mode,
+                    st.st_size)
+                fileVersions.set(self.virtualPath, (st.st_mtime, st.st_size))
+            for fd in self.chunkFds.values():
+                os.close(fd)
+            for node, fd in self.replicaFds.items():
+                if node != self.node:
+                    os.close(fd)
+            for fd in self.deadFds:
+                os.close(fd)
+            if self.tierFd is not None:
+                os.close(self.tierFd)
+            os.close(self.fd)
+            self._releaseReservations()
+            openFiles.closed(self)
 
-        def _fflush(self):
+        @measured
+        def flush(self):
             """
-            Calls flush on self.file, if file is opened in 'a' or 'w' modes.
+            Write out buffered writes, raising any error they ran into, on
+            every close of the file.
             """
 
-            logging.debug('_fflush on %s' % self.fd)
-            if 'w' in self.file.mode or 'a' in self.file.mode:
-                self.file.flush()
+            self.flushBuffer(True)
 
-        def flush(self):
+        @measured
+        def fsync(self, isfsyncfile):
             """
-            Calls self.__flush, closes a dupe fd for current file.
-            I guess closing a dupe of the file leaves the file open, but writes
-            data out.
+            Write out buffered writes and have every node holding a piece of
+            the file commit it, just the data if isfsyncfile is set.
             """
 
-            logging.debug('flush on %s' % self.fd)
-            self._fflush()
-            os.close(os.dup(self.fd))
+            self.flushBuffer(True)
+            sync = isfsyncfile and os.fdatasync or os.fsync
+            fds = set([self.fd] + self.replicaFds.values() + \
+                self.chunkFds.values())
+            for fd in fds:
+                sync(fd)
 
+        @measured
         def fgetattr(self):
             """
             os.fstat wrapper for current file descriptor.
             """
 
-            logging.debug('fgetattr on %s' % self.fd)
+            if self.bufferData:
+                self.flushBuffer(True)
             return os.fstat(self.fd)
 
+        @measured
         def ftruncate(self, length):
             """
             Truncate a file to length bytes.
             """
 
-            logging.debug('ftruncate, len:%s' % length)
-            self.file.truncate(length)
+            self.flushBuffer(True)
+            if cacheTier.root:
+                cacheTier.invalidate(self.virtualPath)
+            if self.stripe:
+                self._trimChunks(length)
+            if self.replicaFds:
+                self._allReplicas(lambda fd: os.ftruncate(fd, length))
+            else:
+                os.ftruncate(self.fd, length)
 
+        @measured
         def lock(self, cmd, owner, **kw):
             """
             Lock file? Dunno.
             """
 
-            logging.debug('lock: %s %s %s' % (cmd, owner, kw))
             return -errno.EINVAL
 
     # ignore args differ from overridden method since we call it directly.
@@ -482,6 +4055,7 @@ class UNFS(Fuse):
         """
 
         self.file_class = self.UnfsFile
+        tracer.listen()
         return Fuse.main(self, *a, **kw)
     # pylint: enable-msg=W0221
 
@@ -495,15 +4069,24 @@ if __name__ == '__main__':
                      usage=usage,
                      dash_s_do='setsingle')
 
-    server.parse(errex=1)
+    for optName, (configName, optType, optHelp) in mountOptions.iteritems():
+        server.parser.add_option(mountopt=optName, type=optType,
+            default=globals()[configName], help=optHelp)
+
+    # callbacks run concurrently unless -s is given
+    server.multithreaded = True
+    server.parse(values=server, errex=1)
+    applyMountOptions(server)
     server.main()
 
-def go():
+def go(options=None):
     """
-    Start from some other script.
+    Start from some other script, options being a '-o' string if given.
     """
 
     cmd = 'python %s %s' % (__file__, mountPoint)
+    if options:
+        cmd += ' -o %s' % options
     os.system(cmd)
 
 def stop():
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+unfsfsck.py checks the nodes of an UNFS pool and reports what the mount
+can't show: paths on several nodes where the first hides the others,
+empty directories a partial rmdir left behind, and how full each node is.
+Empty top level directories missing from some nodes are listed apart, as
+a node added since they were made leaves the same picture.
+It can also write the namespace index from what it saw and show what the
+rebalancer would move.
+
+It reads the nodes under nodeMountPoint directly, so it works with the pool
+mounted or not. While mounted, whatever changes during the crawl may be
+reported wrong.
+"""
+
+import os, sys, stat, time, json, heapq, sqlite3, statvfs, optparse
+import threading, Queue
+import unfs
+
+# config
+jobsPerNode = 4
+reportLimit = 100
+
+class NodeScan(object):
+    """
+    Crawl of one node by a few threads sharing a queue of dirs. Leaves
+    entries holding (virtual path, type bits, size) for everything on the
+    node but unfs' reserved names, sorted by path, size being the number of
+    names inside for dirs.
+    """
+
+    def __init__(self, node, jobs):
+        """
+        Init crawl of node with jobs threads.
+        """
+
+        self.node = node
+        self.jobs = jobs
+        self.entries = []
+        self.reserved = 0
+        self.errors = []
+        self.seconds = 0
+
+    def run(self):
+        """
+        Crawl the node, returning once every dir has been read.
+        """
+
+        start = time.time()
+        dirs = Queue.Queue()
+        dirs.put('')
+        for _ in range(self.jobs):
+            t = threading.Thread(target=self._work, args=(dirs,),
+                name='unfsfsck')
+            t.setDaemon(True)
+            t.start()
+        dirs.join()
+        self.entries.sort()
+        self.seconds = time.time() - start
+
+    def _work(self, dirs):
+        """
+        Read dirs off the queue forever.
+        """
+
+        while True:
+            path = dirs.get()
+            try:
+                self._scanDir(path, dirs)
+            except (OSError, IOError), why:
+                self.errors.append((path or '/', str(why)))
+            finally:
+                dirs.task_done()
+
+    def _scanDir(self, path, dirs):
+        """
+        Record what is in virtual dir path and queue the dirs below it.
+        """
+
+        names = 0
+        for name in unfs.iterDir(self.node + (path or '/')):
+            names += 1
+            if unfs.isReserved(name):
+                self.reserved += 1
+                continue
+            childPath = path + '/' + name
+            try:
+                st = os.lstat(self.node + childPath)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.put(childPath)
+            else:
+                self.entries.append((childPath, stat.S_IFMT(st.st_mode),
+                    st.st_size))
+        self.entries.append((path or '/', stat.S_IFDIR, names))
+
+typeNames = {stat.S_IFDIR: 'dir', stat.S_IFREG: 'file',
+    stat.S_IFLNK: 'symlink'}
+
+def tagged(entries, i):
+    """
+    entries with i put after the path, so merged entries sort in node order.
+    """
+
+    for path, fmt, size in entries:
+        yield path, i, fmt, size
+
+def merge(scans):
+    """
+    Yield (virtual path, [(node, type bits, size), ...]) for every path on
+    any node, in path order, copies in the order of scans.
+    """
+
+    current, copies = None, []
+    streams = [tagged(scan.entries, i) for i, scan in enumerate(scans)]
+    for path, i, fmt, size in heapq.merge(*streams):
+        if path != current:
+            if copies:
+                yield current, copies
+            current, copies = path, []
+        copies.append((scans[i].node, fmt, size))
+    if copies:
+        yield current, copies
+
+def isShadowed(path, copies):
+    """
+    True if copies of path hide each other: more than one and not all dirs,
+    leaving out replicas of a replicated path that still agree.
+    """
+
+    if len(copies) < 2:
+        return False
+    kinds = set([(fmt, fmt != stat.S_IFDIR and size) \
+        for _, fmt, size in copies])
+    if kinds == set([(stat.S_IFDIR, False)]):
+        return False
+    if unfs.replicaCount(path) > 1 and len(kinds) == 1 and \
+            stat.S_IFREG in [fmt for fmt, _ in kinds]:
+        return False
+    return True
+
+def isOrphan(path, copies, parentNodes):
+    """
+    True if dir path is empty on every node holding it but missing from one
+    of parentNodes, the nodes holding its parent. mkdir doesn't leave that
+    but a partial rmdir does; a node added since lacks the parent too.
+    """
+
+    return path != '/' and \
+        all([fmt == stat.S_IFDIR and not size for _, fmt, size in copies]) \
+        and bool(parentNodes - set([node for node, _, _ in copies]))
+
+class IndexWriter(object):
+    """
+    Writes merged paths into a NamespaceIndex database, a new generation
+    replacing whatever the last crawl left.
+    """
+
+    def __init__(self, path):
+        """
+        Open or create the index at path.
+        """
+
+        self.db = sqlite3.connect(path)
+        for sql in unfs.NamespaceIndex.schema:
+            self.db.execute(sql)
+        self.generation = (self.db.execute('SELECT MAX(seen) FROM paths') \
+            .fetchone()[0] or 0) + 1
+        self.rows = []
+        self.count = 0
+
+    def add(self, path, node, fmt, size):
+        """
+        Record path as living on node, written in batches.
+        """
+
+        self.rows.append((unfs.indexText(path),
+            unfs.indexText(os.path.basename(node)), fmt,
+            fmt != stat.S_IFDIR and size or 0, self.generation))
+        if len(self.rows) >= 10000:
+            self._flush()
+
+    def _flush(self):
+        """
+        Write out the batch.
+        """
+
+        self.db.executemany('INSERT OR REPLACE INTO paths VALUES '
+            '(?, ?, ?, ?, ?)', self.rows)
+        self.count += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        """
+        Write out the rest, drop rows from older generations and close.
+        """
+
+        self._flush()
+        self.db.execute('DELETE FROM paths WHERE seen < ?', (self.generation,))
+        self.db.commit()
+        self.db.close()
+
+def check(nodes, jobs=jobsPerNode, indexPath=None):
+    """
+    Crawl nodes in parallel and check them. Returns the report as a dict.
+    """
+
+    scans = [NodeScan(node, jobs) for node in nodes]
+    threads = [threading.Thread(target=scan.run, name='unfsfsck') \
+        for scan in scans]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    index = indexPath and IndexWriter(indexPath)
+    shadowed, orphans, partial = [], [], []
+    # dir -> nodes holding it; a parent sorts, so merges, before its children
+    dirNodes = {'/': set(nodes)}
+    paths = 0
+    for path, copies in merge(scans):
+        paths += 1
+        if isShadowed(path, copies):
+            shadowed.append({'path': path, 'copies': [{'node': node,
+                'type': typeNames.get(fmt, 'special'),
+                'size': size} for node, fmt, size in copies]})
+        elif copies[0][1] == stat.S_IFDIR and path != '/':
+            dirNodes[path] = set([node for node, _, _ in copies])
+            parent = os.path.dirname(path)
+            if isOrphan(path, copies, dirNodes.get(parent, set())):
+                entry = {'path': path,
+                    'nodes': [node for node, _, _ in copies]}
+                # every node holds the root, new ones too
+                if parent == '/':
+                    partial.append(entry)
+                else:
+                    orphans.append(entry)
+        if index and path != '/':
+            index.add(path, *copies[0])
+    if index:
+        index.close()
+
+    usage = {}
+    for scan in scans:
+        files = [size for _, fmt, size in scan.entries if fmt != stat.S_IFDIR]
+        usage[scan.node] = {
+            'files': len(files),
+            'dirs': len(scan.entries) - len(files),
+            'bytes': sum(files),
+            'reserved': scan.reserved,
+            'errors': scan.errors,
+            'seconds': scan.seconds,
+        }
+        try:
+            st = os.statvfs(scan.node)
+        except OSError:
+            continue
+        usage[scan.node].update({
+            'size': st[statvfs.F_BLOCKS] * st[statvfs.F_FRSIZE],
+            'free': unfs.freeBytes(st),
+            'freeFraction': unfs.freeFraction(st),
+        })
+
+    fractions = [u['freeFraction'] for u in usage.values() \
+        if 'freeFraction' in u]
+    imbalance = fractions and max(fractions) - min(fractions) or 0.0
+    return {
+        'nodes': nodes,
+        'paths': paths,
+        'seconds': time.time() - start,
+        'shadowed': shadowed,
+        'orphans': orphans,
+        'partial': partial,
+        'usage': usage,
+        'imbalance': imbalance,
+        'balanced': imbalance < unfs.rebalanceThreshold,
+        'index': index and {'path': indexPath, 'rows': index.count,
+            'generation': index.generation},
+    }
+
+def problems(report):
+    """
+    Number of things wrong in report, leaving out partial top level dirs.
+    """
+
+    return len(report['shadowed']) + len(report['orphans']) + \
+        sum([len(u['errors']) for u in report['usage'].values()])
+
+def text(report, limit=reportLimit):
+    """
+    Human readable report, listing at most limit paths per section.
+    """
+
+    name = os.path.basename
+    lines = ['%d paths on %d nodes in %.1fs' % (report['paths'],
+        len(report['nodes']), report['seconds'])]
+
+    lines.append('%d shadowed' % len(report['shadowed']))
+    for entry in report['shadowed'][:limit]:
+        copies = ['%s (%s, %d)' % (name(c['node']), c['type'], c['size']) \
+            for c in entry['copies']]
+        lines.append('  %s: %s' % (entry['path'], ', '.join(copies)))
+
+    lines.append('%d orphaned empty dirs' % len(report['orphans']))
+    for entry in report['orphans'][:limit]:
+        lines.append('  %s: %s' % (entry['path'],
+            ', '.join([name(node) for node in entry['nodes']])))
+
+    lines.append('%d empty top level dirs not on every node'
+        % len(report['partial']))
+    for entry in report['partial'][:limit]:
+        lines.append('  %s: %s' % (entry['path'],
+            ', '.join([name(node) for node in entry['nodes']])))
+
+    lines.append('usage, imbalance %.3f%s' % (report['imbalance'],
+        not report['balanced'] and ' (over rebalancethreshold)' or ''))
+    for node in report['nodes']:
+        u = report['usage'][node]
+        line = '  %s: %d files, %d dirs, %d bytes' % (name(node), u['files'],
+            u['dirs'], u['bytes'])
+        if 'free' in u:
+            line += ', %d of %d free (%.1f%%)' % (u['free'], u['size'],
+                u['freeFraction'] * 100)
+        lines.append(line)
+        for path, why in u['errors'][:limit]:
+            lines.append('    %s: %s' % (path, why))
+
+    if report['index']:
+        lines.append('index %(path)s: %(rows)d paths, generation '
+            '%(generation)d' % report['index'])
+    return '\n'.join(lines)
+
+def main():
+    """
+    Parse options, check the pool, print the report. Exits 1 if anything was
+    found wrong.
+    """
+
+    parser = optparse.OptionParser(usage='%prog [options] [nodemountpoint]')
+    parser.add_option('-o', dest='options', action='append', default=[],
+        help='comma separated unfs.py mount options, for the replication '
+            'and rebalance settings')
+    parser.add_option('-j', '--jobs', type='int', default=jobsPerNode,
+        help='threads crawling each node')
+    parser.add_option('--index', metavar='PATH',
+        help='write the namespace index of what was found to PATH')
+    parser.add_option('--plan', action='store_true',
+        help='show what the rebalancer would move')
+    parser.add_option('--json', action='store_true',
+        help='print the report as JSON')
+    parser.add_option('--limit', type='int', default=reportLimit,
+        help='paths listed per section of the text report')
+    opts, args = parser.parse_args()
+    if len(args) > 1:
+        parser.error('too many arguments')
+
+    values, rest = unfs.parseOptions(','.join(opts.options))
+    if rest:
+        parser.error('unknown option %s' % rest[0].partition('=')[0])
+    unfs.applyMountOptions(values)
+    if args:
+        unfs.nodeMountPoint = args[0].rstrip('/')
+    unfs.findNewNodes()
+
+    report = check(unfs.unfsNodes, opts.jobs, opts.index)
+    if opts.plan:
+        unfs.rebalanceDryRun = 1
+        unfs.spaceMonitor.sample()
+        plan = unfs.rebalancer.plan()
+        report['plan'] = [{'path': path, 'src': src, 'dst': dst,
+            'size': size} for path, src, dst, size in plan]
+
+    if opts.json:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        print text(report, opts.limit)
+        if opts.plan:
+            print unfs.rebalancer.report(plan)
+    sys.exit(problems(report) and 1 or 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,616 @@
+#!/usr/bin/env python
+"""
+unfsll.py mounts the UNFS filesystem to mountpoint through the llfuse low
+level (inode) API and daemonizes.
+
+Same nodes, options and behaviour as unfs.py, which stays the compatibility
+mode, and the path operations of unfs.UNFS do the work. The difference is
+that the kernel is told how long names and attributes stay good, so its
+dentry and inode caches absorb most lookups instead of every callback
+resolving a full path.
+"""
+
+# ignore complaint about '*args **kwargs' magic.. :P
+# pylint: disable-msg=W0142
+
+import os, errno, stat, threading, optparse, itertools, logging
+import llfuse
+import unfs
+
+# config
+entryTimeout = 5.0
+attrTimeout = 5.0
+negativeTimeout = 1.0
+workerCount = 16
+
+# mount options (-o name=value) that override the config globals above, on
+# top of those in unfs.mountOptions
+llMountOptions = {
+    'entrytimeout': ('entryTimeout', 'float',
+        'seconds the kernel may keep a name without asking again'),
+    'attrtimeout': ('attrTimeout', 'float',
+        'seconds the kernel may keep attributes without asking again'),
+    'negtimeout': ('negativeTimeout', 'float',
+        'seconds the kernel may remember a name is missing, 0 for never'),
+    'workers': ('workerCount', 'int',
+        'threads serving kernel requests'),
+}
+
+# readdir entries the kernel hasn't looked up yet have no inode, but a zero
+# d_ino hides them from readdir(3)
+UNKNOWN_INODE = 0xffffffff
+
+# stats files are made at open and the kernel reads no further than the size
+# it was told, so they claim this much more; a short read sets it straight
+STATS_SLACK = 1024 * 1024
+
+class InodeTable(object):
+    """
+    Inodes the kernel knows -> [virtual path, node hint, lookup count], and
+    virtual path -> inode. An inode lives until the kernel forgets it, its
+    path moves with renames.
+    """
+
+    def __init__(self):
+        """
+        Init table holding just the root.
+        """
+
+        self.inodes = {llfuse.ROOT_INODE: ['/', None, 1]}
+        self.paths = {'/': llfuse.ROOT_INODE}
+        self.counter = itertools.count(llfuse.ROOT_INODE + 1)
+        self.lock = threading.Lock()
+
+    def get(self, inode):
+        """
+        (virtual path, node hint) of inode. ESTALE if it was forgotten.
+        """
+
+        with self.lock:
+            entry = self.inodes.get(inode)
+            if entry is None:
+                raise llfuse.FUSEError(errno.ESTALE)
+            return entry[0], entry[1]
+
+    def path(self, inode):
+        """
+        Virtual path of inode.
+        """
+
+        return self.get(inode)[0]
+
+    def find(self, path):
+        """
+        Inode of virtual path, or None if the kernel doesn't know it.
+        """
+
+        return self.paths.get(path)
+
+    def lookup(self, path, node=None):
+        """
+        Inode for virtual path, made if needed, counting one more kernel
+        reference to it.
+        """
+
+        with self.lock:
+            inode = self.paths.get(path)
+            if inode is None:
+                inode = self.counter.next()
+                self.paths[path] = inode
+                self.inodes[inode] = [path, node, 0]
+            entry = self.inodes[inode]
+            entry[2] += 1
+            if node is not None:
+                entry[1] = node
+            return inode
+
+    def forget(self, inode, count):
+        """
+        Kernel dropped count references to inode.
+        """
+
+        with self.lock:
+            entry = self.inodes.get(inode)
+            if entry is None or inode == llfuse.ROOT_INODE:
+                return
+            entry[2] -= count
+            if entry[2] <= 0:
+                del self.inodes[inode]
+                if self.paths.get(entry[0]) == inode:
+                    del self.paths[entry[0]]
+
+    def unlinked(self, path):
+        """
+        Virtual path is gone; its inode stays for whoever still has it.
+        """
+
+        with self.lock:
+            self.paths.pop(path, None)
+
+    def renamed(self, path, path1):
+        """
+        Virtual path and everything below it is now at path1.
+        """
+
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            self.paths.pop(path1, None)
+            for old in [p for p in self.paths \
+                    if p == path or p.startswith(prefix)]:
+                inode = self.paths.pop(old)
+                new = path1 + old[len(path):]
+                self.paths[new] = inode
+                self.inodes[inode][0] = new
+                self.inodes[inode][1] = None
+
+    def known(self):
+        """
+        (inode, virtual path) of every inode with a path.
+        """
+
+        with self.lock:
+            return [(inode, path) for path, inode in self.paths.items()]
+
+def check(result):
+    """
+    Raise FUSEError for a negative errno returned by a UNFS method, or pass
+    result through.
+    """
+
+    if isinstance(result, int) and result < 0:
+        raise llfuse.FUSEError(-result)
+    return result
+
+def call(func, *args):
+    """
+    func(*args) with UNFS errors turned into FUSEError, and anything else
+    logged and turned into EIO, as it would stop the llfuse main loop. Runs
+    without the llfuse lock so workers wait on nodes in parallel, UNFS being
+    thread safe.
+    """
+
+    try:
+        with llfuse.lock_released:
+            return check(func(*args))
+    except llfuse.FUSEError:
+        raise
+    except (OSError, IOError), why:
+        raise llfuse.FUSEError(why.errno or errno.EIO)
+    # pylint: disable-msg=W0703
+    except Exception:
+        logging.exception('%s failed', getattr(func, '__name__', func))
+        raise llfuse.FUSEError(errno.EIO)
+    # pylint: enable-msg=W0703
+
+def entryAttributes(st, inode, path):
+    """
+    llfuse.EntryAttributes for inode at virtual path from stat result st.
+    """
+
+    attrs = llfuse.EntryAttributes()
+    attrs.st_ino = inode
+    attrs.generation = 0
+    attrs.entry_timeout = entryTimeout
+    attrs.attr_timeout = attrTimeout
+    for name in ('st_mode', 'st_nlink', 'st_uid', 'st_gid', 'st_rdev',
+            'st_size', 'st_blocks'):
+        setattr(attrs, name, getattr(st, name, 0))
+    attrs.st_blksize = getattr(st, 'st_blksize', 0) or 4096
+    for name in ('st_atime', 'st_mtime', 'st_ctime'):
+        setattr(attrs, name + '_ns', int(getattr(st, name, 0) * 1e9))
+
+    if unfs.inStatsDir(path):
+        attrs.entry_timeout = attrs.attr_timeout = 0
+        if stat.S_ISREG(attrs.st_mode):
+            attrs.st_size += STATS_SLACK
+    return attrs
+
+class UnfsOperations(llfuse.Operations):
+    """
+    llfuse request handlers, mapping inodes to virtual paths for unfs.UNFS.
+    """
+
+    def __init__(self):
+        """
+        Init with an empty inode table and no open files.
+        """
+
+        llfuse.Operations.__init__(self)
+        self.fs = unfs.UNFS()
+        self.inodes = InodeTable()
+        self.handles = {}
+        self.handleCounter = itertools.count(1)
+        unfs.nodeListeners.append(self.invalidateAll)
+
+    def init(self):
+        """
+        Called once mounted and daemonized, start background threads.
+        """
+
+        self.fs.fsinit()
+
+    def invalidateAll(self):
+        """
+        Make the kernel ask again about every name and inode it knows, eg.
+        after nodes came or went.
+        """
+
+        for inode, path in self.inodes.known():
+            try:
+                llfuse.invalidate_inode(inode)
+                parent = self.inodes.find(os.path.dirname(path))
+                if parent is not None and path != '/':
+                    llfuse.invalidate_entry(parent, os.path.basename(path))
+            # the kernel may have dropped it meanwhile
+            # pylint: disable-msg=W0703
+            except Exception, why:
+                logging.debug('invalidate %s failed: %s', path, why)
+
+    def _join(self, parentInode, name):
+        """
+        Virtual path of name in dir parentInode.
+        """
+
+        return os.path.join(self.inodes.path(parentInode), name)
+
+    def _entry(self, path, node=None):
+        """
+        Look up virtual path for the kernel, counting the reference.
+        """
+
+        st = call(self.fs.getattr, path)
+        if node is None:
+            node = unfs.locationCache.get(path)
+        return entryAttributes(st, self.inodes.lookup(path, node), path)
+
+    def lookup(self, parent_inode, name, ctx):
+        """
+        Find name in dir parent_inode. Missing names are cached by the kernel
+        for negativeTimeout.
+        """
+
+        path = self._join(parent_inode, name)
+        try:
+            return self._entry(path)
+        except llfuse.FUSEError, why:
+            if why.errno != errno.ENOENT or not negativeTimeout:
+                raise
+        attrs = llfuse.EntryAttributes()
+        attrs.st_ino = 0
+        attrs.entry_timeout = negativeTimeout
+        return attrs
+
+    def forget(self, inode_list):
+        """
+        Kernel dropped references to inodes.
+        """
+
+        for inode, count in inode_list:
+            self.inodes.forget(inode, count)
+
+    def getattr(self, inode, ctx):
+        """
+        Attributes of inode, straight from the node it was found on if it is
+        still there.
+        """
+
+        path, node = self.inodes.get(inode)
+        st = None
+        if node is not None and not unfs.breaker.isDegraded(node):
+            try:
+                with llfuse.lock_released:
+                    # the size has to count writes still buffered, as in
+                    # UNFS.getattr
+                    if unfs.writeBack.handles:
+                        unfs.writeBack.flushPath(path)
+                    st = unfs.nodeStats.timed(node, os.lstat, node + path)
+            except OSError:
+                pass
+        if st is None:
+            try:
+                st = call(self.fs.getattr, path)
+            except llfuse.FUSEError:
+                # unlinked but still open
+                handle = self._handleFor(inode)
+                if handle is None:
+                    raise
+                st = call(handle.fgetattr)
+        return entryAttributes(st, inode, path)
+
+    def setattr(self, inode, attr, fields, fh, ctx):
+        """
+        chmod, chown, truncate and utime in one.
+        """
+
+        path = self.inodes.path(inode)
+        if fields.update_size:
+            if fh in self.handles:
+                call(self.handles[fh][0].ftruncate, attr.st_size)
+            else:
+                call(self.fs.truncate, path, attr.st_size)
+        if fields.update_mode:
+            call(self.fs.chmod, path, stat.S_IMODE(attr.st_mode))
+        if fields.update_uid or fields.update_gid:
+            call(self.fs.chown, path,
+                attr.st_uid if fields.update_uid else -1,
+                attr.st_gid if fields.update_gid else -1)
+        if fields.update_atime or fields.update_mtime:
+            st = call(self.fs.getattr, path)
+            call(self.fs.utime, path, (
+                attr.st_atime_ns / 1e9 if fields.update_atime else st.st_atime,
+                attr.st_mtime_ns / 1e9 if fields.update_mtime else st.st_mtime))
+        return self.getattr(inode, ctx)
+
+    def readlink(self, inode, ctx):
+        """
+        Target of symlink inode.
+        """
+
+        return call(self.fs.readlink, self.inodes.path(inode))
+
+    def opendir(self, inode, ctx):
+        """
+        The inode is the handle.
+        """
+
+        self.inodes.path(inode)
+        return inode
+
+    def readdir(self, fh, off):
+        """
+        Entries of dir fh from off, as UNFS.readdir resumes them.
+        """
+
+        path = self.inodes.path(fh)
+        parent = self.inodes.find(os.path.dirname(path)) or llfuse.ROOT_INODE
+        entries = self.fs.readdir(path, off)
+        while True:
+            # the nodes are listed without the llfuse lock, see call
+            with llfuse.lock_released:
+                entry = next(entries, None)
+            if entry is None:
+                break
+            attrs = llfuse.EntryAttributes()
+            if entry.name == '.':
+                attrs.st_ino = fh
+            elif entry.name == '..':
+                attrs.st_ino = parent
+            else:
+                attrs.st_ino = self.inodes.find(os.path.join(path,
+                    entry.name)) or UNKNOWN_INODE
+            yield entry.name, attrs, entry.offset
+
+    def releasedir(self, fh):
+        """
+        Nothing to close.
+        """
+
+        pass
+
+    def _addHandle(self, handle, inode, flags):
+        """
+        Remember an open UnfsFile, returns its handle number.
+        """
+
+        fh = self.handleCounter.next()
+        self.handles[fh] = (handle, inode, flags)
+        return fh
+
+    def _handleFor(self, inode):
+        """
+        Some open UnfsFile of inode, or None.
+        """
+
+        for handle, handleInode, _ in self.handles.values():
+            if handleInode == inode:
+                return handle
+        return None
+
+    def open(self, inode, flags, ctx):
+        """
+        Open inode, see UNFS.UnfsFile.
+        """
+
+        handle = call(self.fs.UnfsFile, self.inodes.path(inode), flags)
+        return self._addHandle(handle, inode, flags)
+
+    def create(self, parent_inode, name, mode, flags, ctx):
+        """
+        Create and open name in dir parent_inode.
+        """
+
+        path = self._join(parent_inode, name)
+        handle = call(self.fs.UnfsFile, path, flags | os.O_CREAT, mode)
+        inode = self.inodes.lookup(path, handle.node)
+        st = call(handle.fgetattr)
+        return self._addHandle(handle, inode, flags), \
+            entryAttributes(st, inode, path)
+
+    def read(self, fh, off, size):
+        """
+        Read from open file fh.
+        """
+
+        return call(self.handles[fh][0].read, size, off)
+
+    def write(self, fh, off, buf):
+        """
+        Write to open file fh.
+        """
+
+        return call(self.handles[fh][0].write, buf, off)
+
+    def flush(self, fh):
+        """
+        Flush open file fh.
+        """
+
+        call(self.handles[fh][0].flush)
+
+    def fsync(self, fh, datasync):
+        """
+        Commit open file fh to the nodes.
+        """
+
+        call(self.handles[fh][0].fsync, datasync)
+
+    def release(self, fh):
+        """
+        Close open file fh.
+        """
+
+        handle, _, flags = self.handles.pop(fh)
+        call(handle.release, flags)
+
+    def mkdir(self, parent_inode, name, mode, ctx):
+        """
+        Make dir name in dir parent_inode.
+        """
+
+        path = self._join(parent_inode, name)
+        call(self.fs.mkdir, path, mode)
+        return self._entry(path)
+
+    def mknod(self, parent_inode, name, mode, rdev, ctx):
+        """
+        Make node thingy name in dir parent_inode.
+        """
+
+        path = self._join(parent_inode, name)
+        call(self.fs.mknod, path, mode, rdev)
+        return self._entry(path)
+
+    def symlink(self, parent_inode, name, target, ctx):
+        """
+        Make symlink name in dir parent_inode pointing at target.
+        """
+
+        path = self._join(parent_inode, name)
+        call(self.fs.symlink, target, path)
+        return self._entry(path)
+
+    def link(self, inode, new_parent_inode, new_name, ctx):
+        """
+        Hard link inode as new_name in dir new_parent_inode.
+        """
+
+        path = self._join(new_parent_inode, new_name)
+        call(self.fs.link, self.inodes.path(inode), path)
+        return self._entry(path)
+
+    def unlink(self, parent_inode, name, ctx):
+        """
+        Unlink name in dir parent_inode.
+        """
+
+        path = self._join(parent_inode, name)
+        call(self.fs.unlink, path)
+        self.inodes.unlinked(path)
+
+    def rmdir(self, parent_inode, name, ctx):
+        """
+        Remove dir name in dir parent_inode.
+        """
+
+        path = self._join(parent_inode, name)
+        call(self.fs.rmdir, path)
+        self.inodes.unlinked(path)
+
+    def rename(self, parent_inode_old, name_old, parent_inode_new, name_new,
+            ctx):
+        """
+        mv, see UNFS.rename.
+        """
+
+        path = self._join(parent_inode_old, name_old)
+        path1 = self._join(parent_inode_new, name_new)
+        call(self.fs.rename, path, path1)
+        self.inodes.renamed(path, path1)
+
+    def access(self, inode, mode, ctx):
+        """
+        True if inode can be accessed with mode.
+        """
+
+        try:
+            call(self.fs.access, self.inodes.path(inode), mode)
+        except llfuse.FUSEError:
+            return False
+        return True
+
+    def statfs(self, ctx):
+        """
+        Space and inodes of all nodes added up, see UNFS.statfs.
+        """
+
+        st = call(self.fs.statfs)
+        data = llfuse.StatvfsData()
+        for name in ('f_bsize', 'f_frsize', 'f_blocks', 'f_bfree', 'f_bavail',
+                'f_files', 'f_ffree'):
+            setattr(data, name, getattr(st, name))
+        data.f_favail = st.f_ffree
+        return data
+
+def daemonize():
+    """
+    Detach from the terminal, leaving the mount to a child process.
+    """
+
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    devNull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devNull, fd)
+    os.close(devNull)
+
+def main():
+    """
+    Parse options, mount and serve until unmounted.
+    """
+
+    parser = optparse.OptionParser(usage='%prog mountpoint [-o options]')
+    parser.add_option('-o', dest='options', action='append', default=[],
+        help='comma separated mount options, those of unfs.py, ' + \
+            ', '.join(sorted(llMountOptions)) + ' and any fuse takes')
+    parser.add_option('-f', dest='foreground', action='store_true',
+        help='stay in the foreground')
+    parser.add_option('-s', dest='single', action='store_true',
+        help='serve one request at a time')
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('need a mountpoint')
+
+    # whatever neither takes goes to fuse
+    values, rest = unfs.parseOptions(','.join(opts.options),
+        dict(unfs.mountOptions, **llMountOptions))
+    for name, (configName, _, _) in llMountOptions.iteritems():
+        if hasattr(values, name):
+            globals()[configName] = getattr(values, name)
+    unfs.applyMountOptions(values)
+    fuseOptions = set(llfuse.default_options)
+    fuseOptions.add('fsname=unfs')
+    fuseOptions.update(rest)
+    unfs.findNewNodes()
+
+    llfuse.init(UnfsOperations(), args[0], fuseOptions)
+    if not opts.foreground:
+        daemonize()
+    unfs.tracer.listen()
+    try:
+        llfuse.main(workers=opts.single and 1 or workerCount)
+    finally:
+        llfuse.close()
+
+def go(options=None):
+    """
+    Start from some other script, options being a '-o' string if given.
+    """
+
+    cmd = 'python %s %s' % (__file__, unfs.mountPoint)
+    if options:
+        cmd += ' -o %s' % options
+    os.system(cmd)
+
+if __name__ == '__main__':
+    main()